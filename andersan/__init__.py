@@ -10,6 +10,19 @@ Neighbors = dict(
 # ある県のグリッドの範囲。細かさはzoomであとで指定する。
 prefecture_ranges = dict(kanagawa=np.array([[138.94, 35.13], [139.84, 35.66]]))
 
+# 県の範囲の外側で、内挿に使う測定局を拾う幅(度)。固定の幅で、Neighborsの県全体は収まらない
+# (静岡は東経137.5度付近、千葉は140.9度付近まである)。県境の外側で内挿を支える局だけを拾う。
+neighbor_margins = dict(kanagawa=0.5)
+
+
+def neighbor_range(prefecture: str, margin: float | None = None) -> np.ndarray:
+    """県の範囲をmarginだけ広げた経度緯度範囲 [[lon1, lat1], [lon2, lat2]] を返す。
+    marginを省略するとneighbor_marginsの値を使う。"""
+    if margin is None:
+        margin = neighbor_margins[prefecture]
+    pref_range = np.array(prefecture_ranges[prefecture])
+    return np.array([pref_range.min(axis=0) - margin, pref_range.max(axis=0) + margin])
+
 
 
 def interpolate_(point, vertices):
@@ -22,6 +35,42 @@ def interpolate_(point, vertices):
     return p, q, r
 
 
+def barycentric(locations: np.ndarray, grids: np.ndarray, tri: Delaunay = None):
+    """格子点を含むDelaunay三角形の3頂点と混合比を、全格子点について一度に求める。
+
+    interpolate_を格子点ごとに呼ぶかわりに、Delaunay.transform(各三角形の逆行列と原点)を
+    まとめて使う。
+
+    Args:
+        locations (np.ndarray): 測定局のlonlat。shapeは(M, 2)
+        grids (np.ndarray): 内挿したい格子点のlonlat。shapeは(N, 2)
+        tri (Delaunay, optional): locationsから作った三角形分割。省略すると作る。
+
+    Returns:
+        indices, weights: どちらもshapeは(N, 3)。indicesはlocationsの行番号、weightsは混合比。
+            三角形に含まれない格子点はindicesが-1、weightsがNaNになる。
+    """
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    if tri is None:
+        tri = Delaunay(np.asarray(locations, dtype=float))
+
+    triangles = tri.find_simplex(grids)
+    inside = triangles >= 0
+
+    indices = np.full((len(grids), 3), -1, dtype=np.intp)
+    weights = np.full((len(grids), 3), np.nan)
+
+    t = triangles[inside]
+    # transform[t, :2]は逆行列、transform[t, 2]は原点(3番目の頂点)
+    T = tri.transform[t, :2]
+    c = grids[inside] - tri.transform[t, 2]
+    pq = np.einsum("nij,nj->ni", T, c)
+    indices[inside] = tri.simplices[t]
+    weights[inside, :2] = pq
+    weights[inside, 2] = 1 - pq.sum(axis=1)
+    return indices, weights
+
+
 def interpolate(stations: dict, grids: np.ndarray):
     """_summary_
 
@@ -33,6 +82,7 @@ def interpolate(stations: dict, grids: np.ndarray):
         label1, composition1, label2, composition2, label3, composition3:
             grid点を含むDelaunay3角形の3頂点と混合比。
 
+    配列でまとめて欲しいときはbarycentricを使う。
     """
 
     # 内挿する
@@ -41,21 +91,11 @@ def interpolate(stations: dict, grids: np.ndarray):
     # 内挿のためのデータ列を整形
     locations = np.array([stations[x] for x in st])
 
-    # 三角形分割
-    tri = Delaunay(locations)
-
-    triangles = tri.find_simplex(grids)
+    indices, weights = barycentric(locations, grids)
 
-    for i, (gridpoint, triangle) in enumerate(zip(grids, triangles)):
-        if triangle < 0:
+    for (a, b, c), (p, q, r) in zip(indices, weights):
+        if a < 0:
             yield None, None, None, None, None, None
         else:
-            # a, b, cは順序
-            a, b, c = tri.simplices[triangle]
-            # A, B, Cは測定局ラベル
-            A, B, C = st[a], st[b], st[c]
-            p, q, r = interpolate_(gridpoint, locations[tri.simplices[triangle]])
-            # if 0 <= p <= 1 and 0 <= q <= 1 and 0 <= r <= 1:
-            yield A, p, B, q, C, r
-            # else:
-            #     yield A, None, B, None, C, None
+            # a, b, cは順序、A, B, Cは測定局ラベル
+            yield st[a], p, st[b], q, st[c], r
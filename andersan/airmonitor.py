@@ -9,9 +9,8 @@ import numpy as np
 import requests
 import requests_cache
 
-from andersan import tile
+from andersan import tile, interpolation
 from airpollutionwatch.convert import stations as fullstations
-from delaunayextrapolation import DelaunayE
 from airpollutionwatch import kanagawa, shizuoka, tokyo, chiba, yamanashi
 import andersan.archive.airmonitor as archive
 
@@ -171,6 +170,36 @@ def wdws2wxwy(wdws):
 #     return table
 
 
+# AMeDASの観測値で上書きする項目
+AMEDAS_ITEMS = ("TEMP", "WX", "WY")
+
+
+def _overwrite_with_amedas(table: pd.DataFrame, amedas_df: pd.DataFrame, items):
+    """tableのTEMP/WX/WYを、AMeDASの観測値からタイルの経度緯度に内挿した値で上書きする。
+
+    観測値のある観測所の組み合わせが同じ項目は一つの三角形分割を共有し、まとめて一回の
+    行列積で内挿する。外挿はしない(三角形の外はNaN)。観測値がまったくない項目は上書きしない。
+    """
+    targets = [item for item in AMEDAS_ITEMS if item in items and item in amedas_df.columns]
+    if not targets:
+        return
+    values = np.column_stack([amedas_df[item].to_numpy(dtype=float) for item in targets])
+    present = ~np.all(np.isnan(values), axis=0)
+    targets = [item for item, p in zip(targets, present) if p]
+    if not targets:
+        return
+
+    locations = np.column_stack(
+        [amedas_df["lon"].to_numpy(dtype=float), amedas_df["lat"].to_numpy(dtype=float)]
+    )
+    lonlats = np.column_stack(
+        [table["lon"].to_numpy(dtype=float), table["lat"].to_numpy(dtype=float)]
+    )
+    cube = interpolation.interpolate_cube(locations, lonlats, values[np.newaxis, :, present])
+    for k, item in enumerate(targets):
+        table[item] = cube[0, :, k]
+
+
 def apw_tiles_(
     target_prefecture: str,
     datestr: str,
@@ -312,17 +341,19 @@ def apw_tiles_(
     if not first_values_2d:
         return None
 
-    xs: list[int] = []
-    ys: list[int] = []
-    for row_idx, row in enumerate(first_values_2d):
-        ty = ty_max - row_idx  # field の行は南→北
-        for col_idx, _ in enumerate(row):
-            tx = tx_min + col_idx
-            xs.append(tx)
-            ys.append(ty)
-
-    tiles_xy = np.column_stack([xs, ys])
-    lonlats = tile.lonlat(zoom=zoom, xy=tiles_xy)
+    lengths = np.array([len(row) for row in first_values_2d])
+    row_idx = np.repeat(np.arange(len(lengths)), lengths)
+    col_idx = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    # field の行は南→北
+    tiles_xy = np.column_stack([tx_min + col_idx, ty_max - row_idx])
+
+    # 県のgridに収まっていれば、計算済みの経度緯度を使う
+    grid = tile.grid(target_prefecture, zoom)
+    grid_idx = grid.index(tiles_xy)
+    if np.all(grid_idx >= 0):
+        lonlats = grid.lonlats[grid_idx]
+    else:
+        lonlats = tile.lonlat(zoom=zoom, xy=tiles_xy)
     table = pd.DataFrame()
     table["lon"] = lonlats[:, 0]
     table["lat"] = lonlats[:, 1]
@@ -367,9 +398,14 @@ def apw_tiles_(
         if "WS" not in items:
             table.drop(columns=["WS"], inplace=True, errors="ignore")
 
+    # 県の境界にかからないタイルは捨てる（以降の AMeDAS の補間も減る）
+    if np.all(grid_idx >= 0) and not np.all(grid.mask):
+        table = table[grid.mask[grid_idx]]
+
     # use_amedas が有効なら、TEMP/WX/WY について AMeDAS から再補間して上書きする
     if use_amedas:
-        amedas_df = amedas.retrieve(datestr)
+        # 県の周辺の観測所だけを使う
+        amedas_df = amedas.retrieve(datestr, prefecture=target_prefecture)
         amedas_df = amedas_df.replace({pd.NA: None})
         # WX/WY を事前に計算
         if "WD" in amedas_df.columns and "WS" in amedas_df.columns:
@@ -377,25 +413,7 @@ def apw_tiles_(
                 amedas_df[["WD", "WS"]].to_numpy().astype(float)
             )
 
-        lonlats_tiles = table[["lon", "lat"]].to_numpy()
-
-        for item in ("TEMP", "WX", "WY"):
-            if item not in items:
-                continue
-            if item not in amedas_df.columns:
-                continue
-            series2 = amedas_df[["lon", "lat", item]].dropna()
-            if series2.empty:
-                continue
-            tri = DelaunayE(series2[["lon", "lat"]])
-            values = []
-            for lonlat in lonlats_tiles:
-                v, mix = tri.mixratio(lonlat)
-                if np.all(mix > 0):
-                    values.append(mix @ series2.iloc[v][item])
-                else:
-                    values.append(np.nan)
-            table[item] = np.array(values)
+        _overwrite_with_amedas(table, amedas_df, items)
 
     # 呼び出し元が欲しい items 列のみ最低限存在するようにする（欠損時は NaN）
     for item in items:
@@ -413,25 +431,104 @@ def tiles(
     items=["NMHC", "OX", "NOX", "TEMP", "WX", "WY"],  # order in datatype3
     *,
     max_retries: int = 3,
+    tilekey: bool = False,
 ):  # ここで、isodateに時刻が含まれる場合に日付と時だけに修正する。
+    # tilekey=Trueなら、timestampのあとにtile.tilekeyをindexとして加える。
     dt = datetime.datetime.fromisoformat(isodate)
     datestr = dt.strftime("%Y-%m-%dT%H:00:00+09:00")
 
     if dt < datetime.datetime.fromisoformat("2021-04-04T00:00:00+09:00"):
         # use archived data of air monitor, which is provided by archive/airmonitor.py
-        return archive.tiles_(
-            target_prefecture, datestr, zoom, items=items
+        table = archive.tiles_(
+            target_prefecture,
+            datestr,
+            zoom,
+            items=items,
+            boundary=tile.fingerprint(target_prefecture, zoom),
         )
+    else:
+        # それ以降は airpollutionwatch API ベースのタイルを利用
+        # APW は zoom=12 だけなので、他の zoom は zoom=12 の結果から集約/分配する
+        table = apw_tiles_(
+            target_prefecture,
+            datestr,
+            12,
+            use_amedas=use_amedas,
+            items=items,
+            max_retries=max_retries,
+        )
+        if table is not None and zoom != 12:
+            table = tile.rezoom_table(table, zoom)
+            # 県の境界にかかるタイルだけ(ズームを変えた表は長方形全体になる)
+            table = tile.grid(target_prefecture, zoom).select(table)
+    if tilekey and table is not None:
+        table = tile.index_by_tilekey(table)
+    return table
 
-    # それ以降は airpollutionwatch API ベースのタイルを利用
-    return apw_tiles_(
-        target_prefecture,
-        datestr,
-        zoom,
-        use_amedas=use_amedas,
-        items=items,
-        max_retries=max_retries,
-    )
+
+def benchmark_amedas(n: int = 10, n_stations: int = 150, seed: int = 0):
+    """apw_tiles_のAMeDAS上書きを、項目×タイルごとにDelaunayE.mixratioを呼ぶ旧方式と比べる。
+
+    観測所と観測値は県の周辺にランダムに作る(WX/WYは一部の観測所で欠測)。
+    新方式は初回(三角形分割を作る)とキャッシュが効く2回目以降を分けて測る。
+    """
+    from delaunayextrapolation import DelaunayE
+    from andersan import neighbor_range
+
+    rng = np.random.default_rng(seed)
+    lo, hi = neighbor_range("kanagawa")
+    lonlats = rng.uniform(lo, hi, (n_stations, 2))
+    amedas_df = pd.DataFrame(lonlats, columns=["lon", "lat"])
+    amedas_df["TEMP"] = rng.normal(15, 5, n_stations)
+    amedas_df["WX"] = rng.normal(0, 2, n_stations)
+    amedas_df["WY"] = rng.normal(0, 2, n_stations)
+    amedas_df.loc[rng.choice(n_stations, n_stations // 10, replace=False), ["WX", "WY"]] = np.nan
+
+    grid = tile.grid("kanagawa", 12)
+    lonlats_tiles = grid.lonlats[grid.active]
+    table = pd.DataFrame(lonlats_tiles, columns=["lon", "lat"])
+
+    def old():
+        result = table.copy()
+        for item in AMEDAS_ITEMS:
+            series2 = amedas_df[["lon", "lat", item]].dropna()
+            tri = DelaunayE(series2[["lon", "lat"]])
+            values = []
+            for lonlat in lonlats_tiles:
+                v, mix = tri.mixratio(lonlat)
+                if np.all(mix > 0):
+                    values.append(mix @ series2.iloc[v][item])
+                else:
+                    values.append(np.nan)
+            result[item] = np.array(values)
+        return result
+
+    def new():
+        result = table.copy()
+        _overwrite_with_amedas(result, amedas_df, AMEDAS_ITEMS)
+        return result
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        expected = old()
+    old_time = (time.perf_counter() - t0) / n
+
+    interpolation.clear_cache()
+    t0 = time.perf_counter()
+    actual = new()
+    cold_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        actual = new()
+    warm_time = (time.perf_counter() - t0) / n
+
+    columns = list(AMEDAS_ITEMS)
+    same = np.allclose(actual[columns], expected[columns], equal_nan=True)
+    print(f"{len(lonlats_tiles)} tiles, {n_stations} stations, identical: {same}")
+    print(f"DelaunayE loop: {old_time * 1e3:8.2f} ms")
+    print(f"vectorized:     {cold_time * 1e3:8.2f} ms (cold), {warm_time * 1e3:8.2f} ms (cached)")
+    return old_time, cold_time, warm_time
 
 
 def test():
@@ -2,13 +2,13 @@ import sys
 
 sys.path.insert(0, "..")  # for debug
 
-import io
+import os
 import datetime
 import json
-import sqlite3
-import pickle
+import threading
 import time
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 # import requests
 import requests_cache
@@ -18,6 +18,14 @@ import numpy as np
 from logging import basicConfig, getLogger, INFO, DEBUG
 from airpollutionwatch.convert import TEMP, HUM, CODE, LON, LAT, WD, WS
 
+try:
+    from andersan import neighbor_range
+    import andersan.archive.amedas as archive
+except:
+    # for test()
+    from __init__ import neighbor_range
+    import archive.amedas as archive
+
 # apparent nameと内部標準名(そらまめ名)の変換
 converters = {
     # # "地域",
@@ -49,6 +57,14 @@ def validate_amedas_response(response_text, is_retry=False):
     """Amedasレスポンスのvalidationを行う"""
     try:
         data = json.loads(response_text)
+    except json.JSONDecodeError as e:
+        return False, f"JSON解析エラー: {e}"
+    return validate_amedas_data(data, is_retry=is_retry)
+
+
+def validate_amedas_data(data, is_retry=False):
+    """解析済みのAmedasデータのvalidationを行う。JSONを2度解析しなくてすむ。"""
+    try:
         if not isinstance(data, dict):
             return False, "データが辞書形式ではありません"
         
@@ -71,43 +87,53 @@ def validate_amedas_response(response_text, is_retry=False):
         
         return True, f"正常: 観測所数={len(data)}, 温度データあり観測所数={temp_count}"
     
-    except json.JSONDecodeError as e:
-        return False, f"JSON解析エラー: {e}"
     except Exception as e:
         return False, f"予期しないエラー: {e}"
 
 
+def map_url(dt: datetime.datetime) -> str:
+    """指定された時刻のアメダス実況図データのURL"""
+    date_time = dt.strftime("%Y%m%d%H0000")
+    return f"https://www.jma.go.jp/bosai/amedas/data/map/{date_time}.json"
+
+
 def delete_invalid_cache(url):
     """無効なキャッシュを削除する"""
+    delete_cache([url])
+
+
+def delete_cache(urls):
+    """urlsのキャッシュを削除する。
+
+    requests_cacheのキーはリクエストから計算できるので、キャッシュの中身を読まずに、
+    キーを指定してまとめて削除する。
+    """
     logger = getLogger(__name__)
+    urls = list(urls)
     try:
-        conn = sqlite3.connect("airpollution.sqlite")
-        cursor = conn.cursor()
-        
-        # URLに対応するキャッシュを検索
-        cursor.execute("SELECT key, value FROM responses")
-        for key, value in cursor.fetchall():
-            try:
-                response_data = pickle.loads(value) if isinstance(value, bytes) else value
-                if isinstance(response_data, dict) and response_data.get('url') == url:
-                    cursor.execute("DELETE FROM responses WHERE key = ?", (key,))
-                    logger.info(f"無効なキャッシュを削除しました: {url}")
-                    break
-            except Exception:
-                continue
-        
-        conn.commit()
-        conn.close()
+        session = requests_cache.CachedSession("airpollution")
+        session.cache.delete(urls=urls)
+        for url in urls:
+            logger.info(f"キャッシュを削除しました: {url}")
     except Exception as e:
         logger.warning(f"キャッシュ削除エラー: {e}")
 
 
-def retrieve_raw_single(isotime):
-    """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
+def delete_cache_range(start, end):
+    """start以上end未満の各正時のキャッシュを削除する。
+
+    Args:
+        start (str | datetime.datetime): 最初の時刻 (ISO形式可)
+        end (str | datetime.datetime): 最後の時刻 (含まない)
+    """
+    delete_cache([map_url(dt) for dt in hours(start, end)])
+
+
+def retrieve_json(isotime):
+    """指定された日時のデータを入手し、validationを通った解析済みのJSON(dict)を返す。"""
     logger = getLogger(__name__)
     dt = datetime.datetime.fromisoformat(isotime)
-    date_time = dt.strftime("%Y%m%d%H0000")
-    url = f"https://www.jma.go.jp/bosai/amedas/data/map/{date_time}.json"
+    url = map_url(dt)
 
     session = requests_cache.CachedSession("airpollution")
     try:
@@ -118,7 +144,13 @@ def retrieve_raw_single(isotime):
     if response.status_code == 404:
         raise ValueError(f"データが利用できません: {url} (404エラー)")
 
-    is_valid, message = validate_amedas_response(response.text, is_retry=False)
+    try:
+        data = json.loads(response.text)
+    except json.JSONDecodeError as e:
+        data = None
+        is_valid, message = False, f"JSON解析エラー: {e}"
+    else:
+        is_valid, message = validate_amedas_data(data, is_retry=False)
     if not is_valid:
         logger.info(f"Validation失敗: {message}")
         logger.info(f"URL: {url}")
@@ -127,12 +159,20 @@ def retrieve_raw_single(isotime):
         # 無効データは残さない
         delete_invalid_cache(url)
         raise ValueError(f"validation失敗: {message}")
-    
+
     # これがないと文字化けする
     # response.encoding = response.apparent_encoding
 
-    dfs = pd.read_json(io.StringIO(response.text), orient="index")
-    return dfs
+    return data
+
+
+def retrieve_raw_single(isotime):
+    """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
+    data = retrieve_json(isotime)
+    df = pd.DataFrame.from_dict(data, orient="index")
+    # read_jsonと同じく、観測所番号のindexは整数にする
+    df.index = df.index.astype(int)
+    return df
 
 
 def retrieve_raw(isotime):
@@ -140,46 +180,329 @@ def retrieve_raw(isotime):
     return retrieve_raw_single(isotime)
 
 
-def retrieve(isotime):
-    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。"""
-    logger = getLogger()
+# 実況図の測定値は [値, 品質フラグ] の組になっている。
+AMEDAS_ITEMS = ("temp", "humidity", "wind", "windDirection")
 
-    df = retrieve_raw(isotime)
-    # print(df.iloc[0])
-    session = requests_cache.CachedSession("airpollution")
-    # session = requests.Session()
-    response = session.get(
-        f"https://www.jma.go.jp/bosai/amedas/const/amedastable.json",
-    )
-    with open("amedastable.json", "w") as f:
-        f.write(response.text)
-    amedas = pd.read_json(io.StringIO(response.text), orient="index")
-
-    df = pd.merge(df, amedas, left_index=True, right_index=True, how="left").dropna()
-    # 度分を度に変換
-    df["lon"] = [x[0] + x[1] / 60 for x in df["lon"]]
-    df["lat"] = [x[0] + x[1] / 60 for x in df["lat"]]
-    # 第2項目の意味がわからない。
-    # print(df.iloc[0]["temp"][0])
-    for item in ("temp", "humidity", "wind", "windDirection"):
-        temp = []
-        for t in df[item]:
-            if type(t) is list:
-                temp.append(t[0])
-                # 2番目の項目の意味不明。単位指定か?
-            else:
-                temp.append(t)
-        df[item] = temp
-    df["code"] = df.index
-
-    # print(df.columns)
-    # print(df["windDirection"])
+
+def _pairs(records: list, item: str):
+    """各観測所のitemの [値, フラグ] を、値とフラグの配列にする。
+    ないものは値がNaN、フラグが-1になる。"""
+    n = len(records)
+    missing = (None, None)
+    pairs = [rec.get(item, missing) for rec in records]
+    try:
+        # Noneはfloatに変換するとNaNになる
+        array = np.array(pairs, dtype=float).reshape(n, 2)
+    except (TypeError, ValueError):
+        # [値, フラグ] でないものが混じっている
+        array = np.full((n, 2), np.nan)
+        for i, pair in enumerate(pairs):
+            if type(pair) in (list, tuple):
+                array[i] = [np.nan if x is None else x for x in pair[:2]]
+            elif pair is not None:
+                array[i, 0] = pair
+    flags = np.where(np.isnan(array[:, 1]), -1, array[:, 1]).astype(np.int8)
+    return array[:, 0], flags
+
+
+def _degrees(records: list, key: str):
+    """[度, 分] を度にする。"""
+    degmin = np.array([rec[key] for rec in records], dtype=float)
+    return degmin[:, 0] + degmin[:, 1] / 60
+
+
+# 観測所表(amedastable.json)はめったに変わらないので、プロセスで1つだけ持ち、
+# 一定時間ごとに条件付きGET(ETag / If-Modified-Since)で更新を確かめる。
+AMEDAS_TABLE_URL = "https://www.jma.go.jp/bosai/amedas/const/amedastable.json"
+_AMEDAS_TABLE_REFRESH_SECONDS = int(os.getenv("AMEDAS_TABLE_REFRESH_SECONDS", "86400"))
+
+
+class StationTable:
+    """アメダス観測所表。経度緯度は度に換算済みで、観測所番号で引ける。
+
+    Attributes:
+        codes (list[str]): 観測所番号
+        lon, lat (np.ndarray): codesと同じ順の経度・緯度(度)
+        index (dict[str, int]): 観測所番号からcodesの位置へ
+        complete (set[str]): 表のすべての項目がそろっている観測所
+    """
+
+    def __init__(self, url=AMEDAS_TABLE_URL, refresh_seconds=None):
+        self.url = url
+        self.refresh_seconds = (
+            _AMEDAS_TABLE_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        )
+        self.codes: list[str] = []
+        self.lon = np.zeros(0)
+        self.lat = np.zeros(0)
+        self.index: dict[str, int] = {}
+        self.complete: set[str] = set()
+        self._etag = None
+        self._last_modified = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, code) -> bool:
+        return code in self.index
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def _load(self, table: dict) -> None:
+        keys = {}
+        for rec in table.values():
+            keys.update(dict.fromkeys(rec))
+        codes = list(table)
+        records = list(table.values())
+        self.lon = _degrees(records, "lon")
+        self.lat = _degrees(records, "lat")
+        self.codes = codes
+        self.index = {code: i for i, code in enumerate(codes)}
+        self.complete = {code for code, rec in table.items() if len(rec) == len(keys)}
+
+    def within(self, lonlat_range) -> set[str]:
+        """経度緯度範囲 [[lon1, lat1], [lon2, lat2]] に入る観測所の番号。"""
+        lonlat_range = np.asarray(lonlat_range)
+        lo, hi = lonlat_range.min(axis=0), lonlat_range.max(axis=0)
+        inside = (
+            (lo[0] <= self.lon) & (self.lon <= hi[0])
+            & (lo[1] <= self.lat) & (self.lat <= hi[1])
+        )
+        return {self.codes[i] for i in np.flatnonzero(inside)}
+
+    def refresh(self, force=False) -> "StationTable":
+        """前回の確認からrefresh_seconds以上たっていれば、更新されていないか確かめる。"""
+        logger = getLogger(__name__)
+        with self._lock:
+            now = time.monotonic()
+            if (
+                not force
+                and self._checked_at is not None
+                and now - self._checked_at < self.refresh_seconds
+            ):
+                return self
+            headers = {}
+            if self._etag is not None:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified is not None:
+                headers["If-Modified-Since"] = self._last_modified
+            try:
+                response = requests.get(self.url, headers=headers, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if not self.codes:
+                    raise ValueError(f"観測所表を入手できません: {e}")
+                logger.warning(f"観測所表の更新に失敗しました。前回の表を使います: {e}")
+                self._checked_at = now
+                return self
+            self._checked_at = now
+            if response.status_code == 304:
+                logger.debug("観測所表は更新されていません。")
+                return self
+            self._load(json.loads(response.text))
+            self._etag = response.headers.get("ETag")
+            self._last_modified = response.headers.get("Last-Modified")
+            logger.info(f"観測所表を読みこみました: {len(self.codes)}観測所")
+            return self
+
+
+_station_table = StationTable()
+
+
+def station_table() -> StationTable:
+    """プロセスで共有する観測所表。必要なら更新してから返す。"""
+    return _station_table.refresh()
+
+
+def decode(data: dict, stations: StationTable, lonlat_range=None) -> pd.DataFrame:
+    """解析済みの実況図JSONと観測所表から、観測所ごとの表を作る。
+
+    測定値と品質フラグは別の列(itemと{item}_flag)に分ける。
+    従来のmerge+dropnaと同じく、すべての項目がそろった観測所だけを残す。
+
+    Args:
+        data (dict): 実況図のJSON。キーは観測所番号
+        stations (StationTable): 観測所表
+        lonlat_range (optional): 経度緯度範囲 [[lon1, lat1], [lon2, lat2]]。
+            指定すると、範囲外の観測所は配列を作る前に捨てる。
+    """
+    # 全観測所に現れる項目
+    data_keys = {}
+    for rec in data.values():
+        data_keys.update(dict.fromkeys(rec))
+
+    candidates = stations.complete
+    if lonlat_range is not None:
+        candidates = candidates & stations.within(lonlat_range)
+    codes = [
+        code
+        for code, rec in data.items()
+        if len(rec) == len(data_keys) and code in candidates
+    ]
+    records = [data[code] for code in codes]
+    rows = np.array([stations.index[code] for code in codes], dtype=int)
+
+    columns = {}
+    for item in data_keys:
+        if item in AMEDAS_ITEMS:
+            columns[item], columns[f"{item}_flag"] = _pairs(records, item)
+    columns["lat"] = stations.lat[rows]
+    columns["lon"] = stations.lon[rows]
+    columns["code"] = np.array(codes, dtype=np.int64)
+    return pd.DataFrame(columns)
+
+
+def _convert(df: pd.DataFrame) -> pd.DataFrame:
+    """列名をそらまめ名に、単位をそらまめにあわせる。"""
     cols = []
     for col in df.columns:
         if col in converters:
-            cols.append(converters[col](df[col]))
+            converted = converters[col](df[col])
+            cols.append(converted)
+            if f"{col}_flag" in df.columns:
+                cols.append(df[f"{col}_flag"].rename(f"{converted.name}_flag"))
     return pd.concat(cols, axis=1).set_index("code")
-    # return df
+
+
+def _lonlat_range(prefecture=None, lonlat_range=None, margin=None):
+    if lonlat_range is not None:
+        return lonlat_range
+    if prefecture is not None:
+        return neighbor_range(prefecture, margin)
+    return None
+
+
+def _within(df: pd.DataFrame, lonlat_range) -> pd.DataFrame:
+    """decode()の表のうち、経度緯度範囲 [[lon1, lat1], [lon2, lat2]] に入る観測所の行。"""
+    lonlat_range = np.asarray(lonlat_range)
+    lo, hi = lonlat_range.min(axis=0), lonlat_range.max(axis=0)
+    lon, lat = df["lon"].to_numpy(), df["lat"].to_numpy()
+    inside = (lo[0] <= lon) & (lon <= hi[0]) & (lo[1] <= lat) & (lat <= hi[1])
+    return df[inside].reset_index(drop=True)
+
+
+def _decoded(dt: datetime.datetime, lonlat_range=None, stations: StationTable = None):
+    """1時間分のdecode()の表。保存済みならそれを読み、なければJMAから入手して保存する。
+    観測所表(省略時はstation_table())は、アーカイブにないときだけ使う。"""
+    df = archive.load(dt, lonlat_range=lonlat_range)
+    if df is not None:
+        return df
+    data = retrieve_json(dt.isoformat())
+    if stations is None:
+        stations = station_table()
+    # 保存するのは全観測所の表。返す表はそこから範囲内の行を選ぶ
+    full = decode(data, stations)
+    try:
+        archive.store(dt, full)
+    except OSError as e:
+        getLogger(__name__).warning(f"Failed to archive AMeDAS at {dt.isoformat()}: {e}")
+    if lonlat_range is None:
+        return full
+    return _within(full, lonlat_range)
+
+
+def retrieve(isotime, prefecture=None, lonlat_range=None, margin=None):
+    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。
+    品質フラグは{列名}_flagの列に入れる(-1はデータなし)。
+
+    prefectureかlonlat_rangeを指定すると、その範囲の観測所だけを返す。
+    prefectureの場合は、県の範囲をmargin(省略時はneighbor_margins)だけ広げた範囲になる。
+    ローカルのアーカイブ(archive.amedas)にあればそれを使う。
+    """
+    dt = datetime.datetime.fromisoformat(isotime)
+    lonlat_range = _lonlat_range(prefecture, lonlat_range, margin)
+    return _convert(_decoded(dt, lonlat_range))
+
+
+def hours(start, end):
+    """start以上end未満の正時のリスト。"""
+    if isinstance(start, str):
+        start = datetime.datetime.fromisoformat(start)
+    if isinstance(end, str):
+        end = datetime.datetime.fromisoformat(end)
+    dt = start.replace(minute=0, second=0, microsecond=0)
+    if dt < start:
+        dt += datetime.timedelta(hours=1)
+    result = []
+    while dt < end:
+        result.append(dt)
+        dt += datetime.timedelta(hours=1)
+    return result
+
+
+def _each_hour(func, dts, max_workers: int):
+    """各時刻についてfuncを並行して呼ぶ。失敗した時刻は理由を記録して先に進む。"""
+    logger = getLogger(__name__)
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {dt: executor.submit(func, dt) for dt in dts}
+        for dt, future in futures.items():
+            try:
+                results[dt] = future.result()
+            except Exception as e:
+                logger.info(f"Failed to retrieve AMeDAS at {dt.isoformat()}: {e}")
+                failures[dt] = str(e)
+    return results, failures
+
+
+def retrieve_range(
+    start, end, max_workers: int = 8, prefecture=None, lonlat_range=None, margin=None
+):
+    """start以上end未満の各正時のデータを並行して入手する。
+
+    各時刻はretrieveと同じくvalidationを通す。失敗した時刻があっても全体は止めず、
+    失敗の理由を時刻ごとに返す。
+
+    Args:
+        start (str | datetime.datetime): 最初の時刻
+        end (str | datetime.datetime): 最後の時刻 (含まない)
+        max_workers (int, optional): 同時に入手する時刻の数
+        prefecture, lonlat_range, margin (optional): retrieveと同じ。観測所の範囲
+
+    Returns:
+        (pd.DataFrame, dict): indexが(timestamp, code)の縦長の表と、
+            失敗した時刻から理由への辞書
+    """
+    lonlat_range = _lonlat_range(prefecture, lonlat_range, margin)
+
+    def one(dt):
+        return _convert(_decoded(dt, lonlat_range))
+
+    frames, failures = _each_hour(one, hours(start, end), max_workers)
+    if len(frames) == 0:
+        return pd.DataFrame(), failures
+    df = pd.concat(frames, names=["timestamp"])
+    return df, failures
+
+
+def sync(since, until=None, max_workers: int = 8):
+    """since以上until(省略時は現在)未満で、アーカイブにない時刻だけをJMAから入手して保存する。
+
+    Returns:
+        dict: 失敗した時刻から理由への辞書
+    """
+    logger = getLogger(__name__)
+    if until is None:
+        until = datetime.datetime.now(archive.JST)
+    missing = [dt for dt in hours(since, until) if not archive.exists(dt)]
+    logger.info(f"AMeDAS archive: {len(missing)} hours to fetch.")
+    _, failures = _each_hour(_decoded, missing, max_workers)
+    return failures
+
+
+def to_cube(df: pd.DataFrame, items):
+    """retrieve_rangeの縦長の表を、時刻×観測所×項目の3次元配列にする。
+    ない組み合わせはNaN。
+
+    Returns:
+        (pd.Index, pd.Index, np.ndarray): 時刻、観測所番号、配列
+    """
+    t, times = pd.factorize(df.index.get_level_values("timestamp"), sort=True)
+    c, codes = pd.factorize(df.index.get_level_values("code"), sort=True)
+    cube = np.full((len(times), len(codes), len(items)), np.nan)
+    cube[t, c, :] = df[list(items)].to_numpy(dtype=float)
+    return pd.Index(times, name="timestamp"), pd.Index(codes, name="code"), cube
 
 
 def test():
@@ -5,9 +5,8 @@ import pandas as pd
 import numpy as np
 import json
 
-from andersan import tile
+from andersan import tile, interpolation
 from airpollutionwatch.convert import stations as fullstations
-from delaunayextrapolation import DelaunayE
 from airpollutionwatch import kanagawa, shizuoka, tokyo, chiba, yamanashi
 
 # archive/airmonitor.pyはgrid12の値を返すか、あるいは局ごとのデータ(items/)からその場で三角メッシュを切り、
@@ -51,83 +50,90 @@ def wdws2wxwy(wdws):
     return x, y
 
 
+BASE = "/AIR/edamame2/items"
+
+
+def measurements(dt: datetime.datetime, items) -> pd.DataFrame:
+    """ある時刻の測定局ごとの測定値。indexは局番号、columnsはitems。欠測はNaN。"""
+    unixtime = int(dt.timestamp())
+    columns = dict()
+    for item in items:
+        with open(f"{BASE}/{item}/{unixtime}/stations.json") as j:
+            d = json.load(j)
+        columns[item] = pd.Series(
+            {int(station): value for station, value in d.items()}, dtype=float
+        )
+    return pd.DataFrame(columns, columns=list(items))
+
+
+def _jst(t) -> pd.Timestamp:
+    """時刻を日本時間のTimestampにする。タイムゾーンがなければ日本時間とみなす。"""
+    t = pd.Timestamp(t)
+    if t.tzinfo is None:
+        return t.tz_localize("Asia/Tokyo")
+    return t.tz_convert("Asia/Tokyo")
+
+
+def _table(lonlats, tiles, zoom, dts) -> pd.DataFrame:
+    """時刻dtsのそれぞれについて、タイルの経度緯度とX, Y, Zを並べた表。"""
+    n = len(dts)
+    table = pd.DataFrame()
+    table["lon"] = np.tile(lonlats[:, 0], n)
+    table["lat"] = np.tile(lonlats[:, 1], n)
+    table["X"] = np.tile(tiles[:, 0], n)
+    table["Y"] = np.tile(tiles[:, 1], n)
+    table["Z"] = zoom
+    table["timestamp"] = pd.DatetimeIndex(dts).repeat(len(tiles))
+    return table.set_index("timestamp")
+
+
 # @lru_cache(maxsize=9999)
 # @shelf_cache("airmonitor")
-@sqlitedict_cache("archive_airmonitor")  # vscodeで中身をチェックできる分、こちらのほうが便利
+@sqlitedict_cache("archive_airmonitor", negative_ttl=3600)  # vscodeで中身をチェックできる分、こちらのほうが便利
 def tiles_(
     target_prefecture: str,
     isodate: str,
     zoom: int,
     items=["NMHC", "OX", "NOX", "TEMP", "WX", "WY"],  # order in datatype3
+    boundary: str = None,
 ):
-    """各県の特定時刻の大気監視データを入手し、地理院メッシュ点での測定値を内挿する。"""
+    """各県の特定時刻の大気監視データを入手し、県の境界にかかる地理院メッシュ点での測定値を内挿する。
+    boundaryにはtile.fingerprint(target_prefecture, zoom)を渡す。"""
 
     if target_prefecture not in Neighbors:
         return None  # 神奈川以外はまだ動かない
 
-    # 地理院メッシュの間隔
-    pref_range = np.array(prefecture_ranges[target_prefecture])  # lon,lat
-    tiles, shape = tile.tiles(zoom, pref_range)
+    # 地理院メッシュ
+    grid = tile.grid(target_prefecture, zoom)
+    if boundary != grid.fingerprint:
+        raise ValueError(
+            f"boundary must be tile.fingerprint({target_prefecture!r}, {zoom})"
+        )
+    tiles = grid.xy[grid.active]  # 県の境界にかかるタイルだけ
+
+    dt = datetime.datetime.fromisoformat(isodate)
+    # 全県の測定値。欠測はNaNとする。
+    full = measurements(dt, items)
 
-    unixtime = int(datetime.datetime.fromisoformat(isodate).timestamp())
-    # 測定値をとってくる。
-    BASE="/AIR/edamame2/items"
-    full = pd.DataFrame()
-    for item in items:
-        with open(f"{BASE}/{item}/{unixtime}/stations.json") as j:
-            d = json.load(j)
-            # これは遅い処理。もっと簡潔にできる。
-            for station, value in d.items():
-                full.loc[int(station), item] = value
-    
-    # 全県の測定値を連結。欠測はNaNとする。
-    full = full.replace({pd.NA: None})
-    
-    
     # 以下は../airmonitor.pyと同じはず。(amedasを使うところが省かれているけど)
-    
+
     # 神奈川県の範囲
     # 範囲の指定方法を変更
-    lonlats = tile.lonlat(zoom=zoom, xy=tiles)
+    lonlats = grid.lonlats[grid.active]
 
     # 測定値の表。columnsは測定値名
-    table = pd.DataFrame()
-    table["lon"] = lonlats[:, 0]
-    table["lat"] = lonlats[:, 1]
-    table["X"] = tiles[:, 0]
-    table["Y"] = tiles[:, 1]
-    table["Z"] = zoom
-    dt = datetime.datetime.fromisoformat(isodate)
-    table["timestamp"] = dt
-    table = table.set_index("timestamp")
-    for item in items:
-
-        # 欠測の測定局は除外する
-        series = full[item].dropna()
-
-        # itemとlonlatだけのdfを作る。
-        # 各測定局の経度緯度
-        item_df = pd.DataFrame.from_dict(station2lonlat(series.index), orient="index")
-        item_df[item] = series
-        item_df.columns = ["lon", "lat", item]
+    table = _table(lonlats, tiles, zoom, [dt])
 
-        # 副作用をさける
-        del series
+    # 経度緯度がわかっている測定局だけを使う
+    stations = full.index[full.index.isin(fullstations.index)]
+    locations = fullstations.loc[stations, ["経度", "緯度"]].to_numpy(dtype=float)
+    cube = full.loc[stations, items].to_numpy(dtype=float)[np.newaxis]
 
-        # 測定局でDelaunay三角形を作り、gridsの格子点の内挿比を求める
-        tri = DelaunayE(item_df[["lon", "lat"]])
-
-        values = []
-
-        for lonlat in lonlats:
-            v, mix = tri.mixratio(lonlat)
-            if np.all(mix > 0):
-                values.append(mix @ item_df.iloc[v][item])
-            else:
-                # 外挿はしない
-                values.append(np.nan)
-
-        table[item] = np.array(values)
+    # 測定局でDelaunay三角形を作り、gridsの格子点の内挿比を求める
+    # 欠測のない測定局が同じ項目はまとめて一回で内挿する。外挿はしない(三角形の外はNaN)
+    values = interpolation.interpolate_cube(locations, lonlats, cube)
+    for k, item in enumerate(items):
+        table[item] = values[0, :, k]
 
     # table.index = table.index.astype(int)
 
@@ -139,13 +145,78 @@ def tiles(
     isodate: str,
     zoom: int,
     items=["NMHC", "OX", "NOX", "TEMP", "WX", "WY"],  # order in datatype3
+    tilekey: bool = False,
 ):  # ここで、isodateに時刻が含まれる場合に日付と時だけに修正する。
+    # tilekey=Trueなら、timestampのあとにtile.tilekeyをindexとして加える。
     dt = datetime.datetime.fromisoformat(isodate)
     datestr = dt.strftime("%Y-%m-%dT%H:00:00+09:00")
-    return tiles_(
-        target_prefecture, datestr, zoom, items=items
+    table = tiles_(
+        target_prefecture,
+        datestr,
+        zoom,
+        items=items,
+        boundary=tile.fingerprint(target_prefecture, zoom),
+    )
+    if tilekey and table is not None:
+        table = tile.index_by_tilekey(table)
+    return table
+
+
+def hourly_tiles(
+    target_prefecture: str,
+    start: str,
+    end: str,
+    zoom: int,
+    items=["NMHC", "OX", "NOX", "TEMP", "WX", "WY"],
+    method: str = "delaunay",
+    **options,
+):
+    """start以上end未満の各正時についてtiles_と同じ表を作り、縦に連結して返す。
+
+    時刻×測定局×項目の配列にまとめ、欠測のない測定局が同じ(時刻, 項目)ごとに
+    一回の行列積で内挿するので、日単位のbackfillではtiles_を毎時呼ぶより速い。
+    tiles_のキャッシュは使わない。測定値のファイルがそろわない時刻はすべてNaN。
+    method="idw"なら、APWと同じく三角形の外も近くの局から内挿する(optionsはinterpolation.build_idwへ)。
+    """
+    logger = getLogger(__name__)
+    if target_prefecture not in Neighbors:
+        return None
+
+    grid = tile.grid(target_prefecture, zoom)
+    tiles = grid.xy[grid.active]  # 県の境界にかかるタイルだけ
+    lonlats = grid.lonlats[grid.active]
+
+    # tilesと同じく、時刻は日本時間(+09:00)。タイムゾーンのない時刻も日本時間とみなす
+    start, end = (_jst(t) for t in (start, end))
+    dts = pd.date_range(start.ceil("h"), end, freq="h", inclusive="left").to_pydatetime()
+
+    hourly = []
+    for dt in dts:
+        try:
+            hourly.append(measurements(dt, items))
+        except FileNotFoundError as e:
+            logger.info(f"No measurements at {dt.isoformat()}: {e}")
+            hourly.append(pd.DataFrame(columns=list(items), dtype=float))
+    if len(hourly) == 0:
+        return None
+
+    # 時刻×測定局×項目。経度緯度がわかっている測定局だけを使う
+    stations = pd.Index(sorted(set().union(*[df.index for df in hourly])))
+    stations = stations[stations.isin(fullstations.index)]
+    locations = fullstations.loc[stations, ["経度", "緯度"]].to_numpy(dtype=float)
+    cube = np.stack(
+        [df.reindex(index=stations, columns=items).to_numpy(dtype=float) for df in hourly]
+    )
+
+    values = interpolation.interpolate_cube(
+        locations, lonlats, cube, method=method, **options
     )
 
+    table = _table(lonlats, tiles, zoom, list(dts))
+    for k, item in enumerate(items):
+        table[item] = values[:, :, k].ravel()
+    return table
+
 
 def test():
     basicConfig(level=DEBUG)
@@ -0,0 +1,110 @@
+# アメダス実況図の1時間ごとのデータを、日付で分割したParquetに保存しておく。
+# JMAは最近のデータしか配信しないので、取得できたものはここに残す。
+#
+#   {AMEDAS_ARCHIVE_DIR}/date=2025-02-20/22.parquet
+#
+# 各ファイルはamedas.decode()の表(観測所ごとの値・フラグ・経度緯度)。
+
+import os
+import contextlib
+import datetime
+import tempfile
+from logging import getLogger
+
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+
+ARCHIVE_DIR = os.getenv("AMEDAS_ARCHIVE_DIR", "amedas_archive")
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def _jst(dt: datetime.datetime) -> datetime.datetime:
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=JST)
+    return dt.astimezone(JST)
+
+
+def path(dt: datetime.datetime, root: str = None) -> str:
+    """その時刻のファイルの場所"""
+    dt = _jst(dt)
+    return os.path.join(
+        root or ARCHIVE_DIR, f"date={dt.strftime('%Y-%m-%d')}", f"{dt.hour:02d}.parquet"
+    )
+
+
+def exists(dt: datetime.datetime, root: str = None) -> bool:
+    """その時刻のファイルが読めればTrue。壊れたファイルはないものとして、取りなおさせる。"""
+    filename = path(dt, root)
+    if not os.path.exists(filename):
+        return False
+    try:
+        pq.read_metadata(filename)
+    except Exception as e:
+        getLogger(__name__).warning(f"Broken AMeDAS archive {filename}: {e}")
+        return False
+    return True
+
+
+def store(dt: datetime.datetime, df: pd.DataFrame, root: str = None) -> None:
+    """1時間分の表を保存する。書きかけのファイルが残らないように、別名で書いてから置きかえる。
+    別名はmkstempで作るので、同じ時刻を同時に保存しても(スレッドでもプロセスでも)混ざらない。"""
+    filename = path(dt, root)
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            df.to_parquet(f, index=False)
+        os.replace(tmp, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def load(dt: datetime.datetime, root: str = None, lonlat_range=None):
+    """1時間分の表を読む。なければNone。
+
+    Args:
+        lonlat_range (optional): 経度緯度範囲 [[lon1, lat1], [lon2, lat2]]。範囲外の観測所は読まない。
+    """
+    filename = path(dt, root)
+    if not os.path.exists(filename):
+        return None
+    filters = None
+    if lonlat_range is not None:
+        lonlat_range = np.asarray(lonlat_range)
+        lo, hi = lonlat_range.min(axis=0), lonlat_range.max(axis=0)
+        filters = [
+            ("lon", ">=", lo[0]),
+            ("lon", "<=", hi[0]),
+            ("lat", ">=", lo[1]),
+            ("lat", "<=", hi[1]),
+        ]
+    try:
+        return pd.read_parquet(filename, filters=filters)
+    except Exception as e:
+        getLogger(__name__).warning(f"Broken AMeDAS archive {filename}: {e}")
+        return None
+
+
+def load_range(start, end, root: str = None) -> pd.DataFrame:
+    """start以上end未満の保存済みの時刻をまとめて読む。timestamp列がつく。
+    日付のディレクトリで絞ってから読むので、範囲外のファイルは開かない。"""
+    start, end = _jst(start), _jst(end)
+    root = root or ARCHIVE_DIR
+    if not os.path.isdir(root):
+        return pd.DataFrame()
+    files = []
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < end:
+        for hour in range(24):
+            dt = day + datetime.timedelta(hours=hour)
+            if start <= dt < end and exists(dt, root):
+                files.append((dt, path(dt, root)))
+        day += datetime.timedelta(days=1)
+    if not files:
+        return pd.DataFrame()
+    frames = {dt: pd.read_parquet(filename) for dt, filename in files}
+    return pd.concat(frames, names=["timestamp"]).reset_index(level=0)
@@ -34,7 +34,10 @@ OPENMETEO_ITEMS = [
 @sqlitedict_cache(
     "archive_openmeteo"
 )  # vscodeで中身をチェックできる分、こちらのほうが便利
-def tiles(target_prefecture: str, datehour: str, hours:int, zoom: int) -> pd.DataFrame:
+def tiles(
+    target_prefecture: str, datehour: str, hours: int, zoom: int, boundary: str = None
+) -> pd.DataFrame:
+    """県の境界にかかるタイルの記録。boundaryにはandersan.tile.fingerprint(target_prefecture, zoom)を渡す。"""
     # 24時間分を返す?
     logger = getLogger()
 
@@ -55,9 +58,13 @@ def tiles(target_prefecture: str, datehour: str, hours:int, zoom: int) -> pd.Dat
     dt_end = dt_start + datetime.timedelta(hours=hours-1)
 
 
-    # 地理院メッシュの間隔
-    pref_range = np.array(prefecture_ranges[target_prefecture])  # lon,lat
-    tiles, shape = andersan_tile.tiles(zoom, pref_range)
+    # 地理院メッシュ
+    grid = andersan_tile.grid(target_prefecture, zoom)
+    if boundary != grid.fingerprint:
+        raise ValueError(
+            f"boundary must be tile.fingerprint({target_prefecture!r}, {zoom})"
+        )
+    tiles = grid.xy[grid.active]  # 県の境界にかかるタイルだけ
 
     all_forecast_dataframe = pd.DataFrame()
     Z = 12
@@ -75,7 +82,13 @@ def tiles(target_prefecture: str, datehour: str, hours:int, zoom: int) -> pd.Dat
 def test():
     basicConfig(level=INFO)
     logger = getLogger()
-    df = tiles("kanagawa", "2021-03-31T06", hours=7, zoom=12)
+    df = tiles(
+        "kanagawa",
+        "2021-03-31T06",
+        hours=7,
+        zoom=12,
+        boundary=andersan_tile.fingerprint("kanagawa", 12),
+    )
     logger.info(df)
 
 
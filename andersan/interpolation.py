@@ -0,0 +1,404 @@
+"""
+測定局の値を格子点に内挿する。
+
+測定局の配置と格子点が同じなら内挿比も同じなので、(格子点 × 測定局)の疎行列Wとして一度だけ作り、
+以後はW @ valuesで内挿する。
+
+内挿のしかた(engine)は3つ。どれも(測定局, 格子点)から内挿行列を作る関数で、ENGINESに名前で登録する。
+    delaunay: 格子点を含むDelaunay三角形の頂点の混合比。三角形の外は外挿しない(NaN)。
+    idw: cKDTreeで近いk局をさがし、距離のpower乗の逆数で重みをつける(APWのmethod="idw"に相当)。
+    nearest: いちばん近い局の値。
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from typing import NamedTuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay, QhullError, cKDTree
+
+try:
+    from andersan import barycentric
+except:
+    # for test()
+    from __init__ import barycentric
+
+
+# 保持する内挿行列の数。県×zoom×測定局の組み合わせ程度あれば足りる。
+WEIGHT_CACHE_SIZE = int(os.getenv("ANDERSAN_WEIGHT_CACHE_SIZE", "64"))
+
+
+def _readonly(a: np.ndarray) -> np.ndarray:
+    a.flags.writeable = False
+    return a
+
+
+class WeightMatrix(NamedTuple):
+    """測定局の値から格子点の値を作る内挿行列。
+
+    matrixは(格子点数, 測定局数)のCSR行列、coveredはどれかの三角形に含まれる格子点。
+    """
+
+    matrix: csr_matrix
+    covered: np.ndarray
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def apply(self, values) -> np.ndarray:
+        """測定局の値(shapeは(測定局数,)または(測定局数, k))を内挿する。
+        三角形に含まれない格子点はNaN(外挿はしない)。"""
+        values = np.asarray(values, dtype=float)
+        result = self.matrix @ values
+        result[~self.covered] = np.nan
+        return result
+
+
+def _matrix(indices: np.ndarray, weights: np.ndarray, strict: bool, n_stations: int) -> WeightMatrix:
+    """barycentricの結果を内挿行列にする。"""
+    covered = indices[:, 0] >= 0
+    if strict:
+        covered &= np.all(weights > 0, axis=1)
+
+    rows = np.repeat(np.flatnonzero(covered), 3)
+    matrix = csr_matrix(
+        (weights[covered].ravel(), (rows, indices[covered].ravel())),
+        shape=(len(indices), n_stations),
+    )
+    return WeightMatrix(matrix, _readonly(covered))
+
+
+def build(locations: np.ndarray, grids: np.ndarray, strict: bool = True) -> WeightMatrix:
+    """測定局のlonlat locations (M, 2)と格子点のlonlat grids (N, 2)から内挿行列を作る。
+
+    strict=Trueなら、混合比がすべて正の格子点だけを内挿する(DelaunayE.mixratioで
+    np.all(mix > 0)を判定していたのと同じ)。
+    """
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    indices, weights = barycentric(locations, grids)
+    return _matrix(indices, weights, strict, len(locations))
+
+
+class Triangulation(NamedTuple):
+    """全測定局の三角形分割と、各格子点を含む三角形の頂点と混合比(barycentricの結果)。"""
+
+    tri: Delaunay
+    indices: np.ndarray
+    weights: np.ndarray
+
+
+def triangulate(locations: np.ndarray, grids: np.ndarray) -> Triangulation:
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    tri = Delaunay(locations)
+    indices, weights = barycentric(locations, grids, tri=tri)
+    return Triangulation(tri, _readonly(indices), _readonly(weights))
+
+
+def patch(
+    base: Triangulation,
+    locations: np.ndarray,
+    grids: np.ndarray,
+    valid: np.ndarray,
+    strict: bool = True,
+) -> WeightMatrix:
+    """全測定局の三角形分割baseから、欠測のない測定局(valid)だけの内挿行列を作る。
+
+    測定局を取り除いても、Delaunay三角形が変わるのはその局を頂点とする三角形の和(穴)の中だけで、
+    穴は穴のまわりの測定局のDelaunay三角形で埋まる。そこで、欠測局を頂点とする三角形に
+    含まれる格子点だけ、まわりの測定局で三角形を作りなおして混合比を求める。
+    結果の列はlocations[valid]の順で、build(locations[valid], grids)と同じになる。
+    """
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    valid = np.asarray(valid, dtype=bool)
+    missing = ~valid
+
+    indices = base.indices.copy()
+    weights = base.weights.copy()
+    affected = (indices[:, 0] >= 0) & np.any(missing[indices], axis=1)
+
+    # 穴のまわりの測定局
+    hole = base.tri.simplices[np.any(missing[base.tri.simplices], axis=1)]
+    local = np.unique(hole)
+    local = local[valid[local]]
+
+    indices[affected] = -1
+    weights[affected] = np.nan
+    if len(local) >= 3 and np.any(affected):
+        try:
+            li, lw = barycentric(locations[local], grids[affected])
+        except QhullError:
+            # まわりの測定局が一直線上にあるなど。作りなおす。
+            return build(locations[valid], grids, strict=strict)
+        indices[affected] = np.where(li >= 0, local[li], -1)
+        weights[affected] = lw
+
+    # 列を有効な測定局だけに詰める
+    column = np.cumsum(valid) - 1
+    indices = np.where(indices >= 0, column[indices], -1)
+    return _matrix(indices, weights, strict, int(valid.sum()))
+
+
+def _planar(lonlats: np.ndarray, lat0: float) -> np.ndarray:
+    """経度を緯度lat0でのcosで縮め、距離がおよそ等方的になるようにする(単位は緯度の度)。"""
+    return lonlats * np.array([np.cos(np.radians(lat0)), 1.0])
+
+
+def build_idw(
+    locations: np.ndarray,
+    grids: np.ndarray,
+    k: int = 8,
+    power: float = 2.0,
+    max_distance: float | None = None,
+) -> WeightMatrix:
+    """近いk局の値を、距離のpower乗の逆数で重みづけして平均する内挿行列。
+
+    max_distance(緯度の度)より遠い局は使わず、1局もなければNaN。測定局と重なる格子点はその局の値。
+    """
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    M = len(locations)
+    k = min(k, M)
+    lat0 = locations[:, 1].mean()
+    tree = cKDTree(_planar(locations, lat0))
+    distances, indices = tree.query(
+        _planar(grids, lat0),
+        k=k,
+        distance_upper_bound=np.inf if max_distance is None else max_distance,
+    )
+    distances = distances.reshape(len(grids), k)
+    indices = indices.reshape(len(grids), k)
+
+    # 見つからなかった近傍はindexがM、距離がinf
+    found = indices < M
+    with np.errstate(divide="ignore"):
+        weights = np.where(found, distances, np.inf) ** -power
+    exact = found & (distances == 0)
+    on_station = exact.any(axis=1)
+    weights[on_station] = exact[on_station]
+    covered = found.any(axis=1)
+    weights[covered] /= weights[covered].sum(axis=1, keepdims=True)
+
+    rows = np.repeat(np.arange(len(grids)), k).reshape(-1, k)
+    matrix = csr_matrix(
+        (weights[found], (rows[found], indices[found])), shape=(len(grids), M)
+    )
+    return WeightMatrix(matrix, _readonly(covered))
+
+
+def build_nearest(
+    locations: np.ndarray, grids: np.ndarray, max_distance: float | None = None
+) -> WeightMatrix:
+    """いちばん近い局の値をとる内挿行列。max_distanceより遠ければNaN。"""
+    return build_idw(locations, grids, k=1, max_distance=max_distance)
+
+
+# 内挿のしかたの名前と、内挿行列を作る関数
+ENGINES = dict(delaunay=build, idw=build_idw, nearest=build_nearest)
+
+
+def _digest(*arrays, tag: str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype=float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    h.update(tag.encode())
+    return h.digest()
+
+
+_weights = OrderedDict()
+_weights_lock = threading.Lock()
+
+
+def _cached(key: bytes, make):
+    with _weights_lock:
+        if key in _weights:
+            _weights.move_to_end(key)
+            return _weights[key]
+    value = make()
+    with _weights_lock:
+        _weights[key] = value
+        while len(_weights) > WEIGHT_CACHE_SIZE:
+            _weights.popitem(last=False)
+    return value
+
+
+def weight_matrix(
+    locations: np.ndarray,
+    grids: np.ndarray,
+    strict: bool = True,
+    valid=None,
+    method: str = "delaunay",
+    **options,
+) -> WeightMatrix:
+    """ENGINES[method]と同じだが、測定局の配置と格子点が前回までと同じならキャッシュを返す。
+
+    測定局の順序は行列の列の順序なので、キーにも含まれる。strictはdelaunayのときだけ使う。
+    optionsはengineにそのまま渡す(idwのk, powerなど)。
+    validを与えると、locations[valid]の局だけの内挿行列を返す。delaunayでは全局の三角形分割を
+    キャッシュしておき、欠測局のまわりだけをpatchで作りなおす。
+    """
+    logger = getLogger(__name__)
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    if method not in ENGINES:
+        raise ValueError(f"Unknown interpolation method: {method}")
+    if method == "delaunay":
+        options = dict(options, strict=strict)
+    tag = f"{method} {sorted(options.items())}"
+    if valid is not None:
+        valid = np.asarray(valid, dtype=bool)
+        if valid.all():
+            valid = None
+
+    if valid is None or method != "delaunay":
+        if valid is not None:
+            locations = locations[valid]
+
+        def make():
+            logger.debug(
+                f"Building {method} weight matrix: {len(grids)} points x {len(locations)} stations"
+            )
+            return ENGINES[method](locations, grids, **options)
+
+        return _cached(_digest(locations, grids, tag=tag), make)
+
+    def make_base():
+        logger.debug(f"Triangulating {len(locations)} stations for {len(grids)} points")
+        return triangulate(locations, grids)
+
+    def make_patch():
+        logger.debug(f"Patching weight matrix: {int((~valid).sum())} stations missing")
+        base = _cached(_digest(locations, grids, tag="triangulation"), make_base)
+        return patch(base, locations, grids, valid, strict=strict)
+
+    # 欠測のない局だけでbuildしたものと同じキー
+    return _cached(_digest(locations[valid], grids, tag=tag), make_patch)
+
+
+def clear_cache():
+    with _weights_lock:
+        _weights.clear()
+
+
+def interpolate_cube(
+    locations: np.ndarray,
+    grids: np.ndarray,
+    cube: np.ndarray,
+    strict: bool = True,
+    method: str = "delaunay",
+    **options,
+) -> np.ndarray:
+    """時刻×測定局×項目の測定値をまとめて内挿し、時刻×格子点×項目の配列を返す。
+
+    欠測はNaN。欠測のない測定局の組み合わせが同じ(時刻, 項目)どうしは同じ内挿行列になるので、
+    組み合わせごとに一回の行列積で内挿する。有効な測定局が足りない(delaunayでは3局未満)
+    組み合わせはNaNのまま。method, optionsはweight_matrixと同じ。
+
+    Args:
+        locations (np.ndarray): 測定局のlonlat。shapeは(M, 2)
+        grids (np.ndarray): 格子点のlonlat。shapeは(N, 2)
+        cube (np.ndarray): shapeは(T, M, K)。amedas.to_cubeと同じ並び。
+
+    Returns:
+        np.ndarray: shapeは(T, N, K)
+    """
+    logger = getLogger(__name__)
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    grids = np.asarray(grids, dtype=float).reshape(-1, 2)
+    cube = np.asarray(cube, dtype=float)
+    T, M, K = cube.shape
+
+    # 測定局 × (時刻, 項目)
+    columns = cube.transpose(1, 0, 2).reshape(M, T * K)
+    valid = ~np.isnan(columns)
+    # 有効な測定局の組み合わせごとに列をまとめる(ビット列にしてdictで引く)
+    groups = dict()
+    for j, key in enumerate(np.packbits(valid, axis=0).T):
+        groups.setdefault(key.tobytes(), []).append(j)
+
+    result = np.full((len(grids), T * K), np.nan)
+    for selected in groups.values():
+        pattern = valid[:, selected[0]]
+        if pattern.sum() < (3 if method == "delaunay" else 1):
+            logger.debug(f"Too few stations ({pattern.sum()}) to interpolate.")
+            continue
+        # 欠測局のまわりだけ全局の三角形分割から作りなおす
+        W = weight_matrix(
+            locations, grids, strict=strict, valid=pattern, method=method, **options
+        )
+        result[:, selected] = W.apply(columns[pattern][:, selected])
+    return result.reshape(len(grids), T, K).transpose(1, 0, 2)
+
+
+def benchmark(
+    n_stations: int = 150,
+    holdout: float = 0.15,
+    prefecture: str = "kanagawa",
+    zoom: int = 12,
+    columns: int = 24 * 6,
+    seed: int = 0,
+):
+    """engineごとに、内挿行列を作る時間、適用する時間、取り除いた測定局での精度を比べる。
+
+    測定局は県の範囲を少し広げた中にランダムにおき、なめらかな場の値をもたせる。
+    一部の局を取り除いて残りの局から内挿し、取り除いた局の位置での誤差(RMSE)と、
+    値が得られた割合(coverage)を求める。適用時間は県のgridに24時間×6項目を内挿する時間。
+    """
+    try:
+        from andersan import tile, neighbor_range
+    except:
+        # for test()
+        import tile
+        from __init__ import neighbor_range
+
+    rng = np.random.default_rng(seed)
+    lo, hi = neighbor_range(prefecture, margin=0.3)
+    locations = rng.uniform(lo, hi, (n_stations, 2))
+
+    def field(lonlats):
+        lon, lat = lonlats[:, 0], lonlats[:, 1]
+        return np.sin(3 * lon) * np.cos(4 * lat) + 0.3 * lon - 0.5 * lat
+
+    held = np.zeros(n_stations, dtype=bool)
+    held[rng.choice(n_stations, int(n_stations * holdout), replace=False)] = True
+    train, test = locations[~held], locations[held]
+
+    grid = tile.grid(prefecture, zoom)
+    grids = grid.lonlats[grid.active]
+    values = rng.normal(size=(len(train), columns))
+
+    results = {}
+    for method, engine in ENGINES.items():
+        t0 = time.perf_counter()
+        W = engine(train, grids)
+        build_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        W.apply(values)
+        apply_time = time.perf_counter() - t0
+
+        estimate = engine(train, test).apply(field(train))
+        ok = ~np.isnan(estimate)
+        rmse = np.sqrt(np.mean((estimate[ok] - field(test)[ok]) ** 2))
+        results[method] = dict(
+            build=build_time, apply=apply_time, rmse=rmse, coverage=ok.mean()
+        )
+        print(
+            f"{method:8s} build {build_time * 1e3:7.2f} ms, apply {apply_time * 1e3:7.2f} ms, "
+            f"rmse {rmse:.4f}, coverage {ok.mean():.2f}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    benchmark()
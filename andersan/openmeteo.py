@@ -30,18 +30,27 @@ OPENMETEO_ITEMS = [
 
 # @lru_cache
 # @shelf_cache("openmeteo")
-@sqlitedict_cache("openmeteo")  # vscodeで中身をチェックできる分、こちらのほうが便利
-def tiles_(target_prefecture: str, datestr: str, zoom: int) -> pd.DataFrame:
+@sqlitedict_cache(
+    "openmeteo", memory_bytes=64 * 2**20, negative_ttl=3600
+)  # vscodeで中身をチェックできる分、こちらのほうが便利
+def tiles_(
+    target_prefecture: str, datestr: str, zoom: int, boundary: str = None
+) -> pd.DataFrame:
+    """県の境界にかかるタイルの予報。boundaryにはtile.fingerprint(target_prefecture, zoom)を渡す。
+    境界のファイルが変わるとboundaryも変わるので、古いキャッシュは使われない。"""
     logger = getLogger()
 
     if target_prefecture not in Neighbors:  # 神奈川以外はまだ動かない
         return None
 
-    # 地理院メッシュの間隔
-    pref_range = np.array(prefecture_ranges[target_prefecture])  # lon,lat
-    tiles, shape = tile.tiles(zoom, pref_range)
-
-    lonlats = tile.lonlat(xy=tiles, zoom=zoom)
+    # 地理院メッシュ
+    grid = tile.grid(target_prefecture, zoom)
+    if boundary != grid.fingerprint:
+        raise ValueError(
+            f"boundary must be tile.fingerprint({target_prefecture!r}, {zoom})"
+        )
+    # 県の境界にかかるタイルだけ
+    tiles, lonlats = grid.xy[grid.active], grid.lonlats[grid.active]
     # Setup the cache and retry mechanism
     cache_session = requests_cache.CachedSession("airpollution")
     retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
@@ -92,6 +101,7 @@ def tiles0(target_prefecture: str, isodate: str, zoom: int) -> pd.DataFrame:
     # そうしないと、キャッシュに同じデータが24個も保管されてしまう。
     dt = datetime.datetime.fromisoformat(isodate)
     datestr = dt.strftime("%Y-%m-%d")
+    boundary = tile.fingerprint(target_prefecture, zoom)
 
     if datetime.datetime.fromisoformat(
         dt.strftime("%Y-%m-%dT00:00:00+09:00")
@@ -99,10 +109,13 @@ def tiles0(target_prefecture: str, isodate: str, zoom: int) -> pd.DataFrame:
         # use archived data of air monitor, which is provided by archive/openmeteo.py
         return archive.tiles_(target_prefecture, datestr, zoom)
 
-    return tiles_(target_prefecture, datestr, zoom)
+    return tiles_(target_prefecture, datestr, zoom, boundary=boundary)
 
 
-def tiles(target_prefecture: str, datehour: str, hours: int, zoom: int) -> pd.DataFrame:
+def tiles(
+    target_prefecture: str, datehour: str, hours: int, zoom: int, tilekey: bool = False
+) -> pd.DataFrame:
+    """tilekey=Trueなら、X, Y, Zから作ったtile.tilekeyをindexにする。"""
     # ここで、isodateに時刻が含まれる場合に日付と時だけに修正する。
     if datehour == "now":
         dt = datetime.datetime.now()
@@ -121,14 +134,23 @@ def tiles(target_prefecture: str, datehour: str, hours: int, zoom: int) -> pd.Da
 
     if dt_end < datetime.datetime.fromisoformat("2021-04-04T00:00:00+09:00"):
         # use archived data of air monitor, which is provided by archive/openmeteo.py
-        return archive.tiles(target_prefecture, datehour, hours, zoom)
-
-    df = pd.DataFrame()
-    while dt_day < dt_end:
-        df = pd.concat([df, tiles0(target_prefecture, dt_day.isoformat(), zoom)])
-        dt_day += datetime.timedelta(hours=24)
-
-    return df[(dt_start <= df.date) & (df.date < dt_end)]
+        df = archive.tiles(
+            target_prefecture,
+            datehour,
+            hours,
+            zoom,
+            boundary=tile.fingerprint(target_prefecture, zoom),
+        )
+    else:
+        df = pd.DataFrame()
+        while dt_day < dt_end:
+            df = pd.concat([df, tiles0(target_prefecture, dt_day.isoformat(), zoom)])
+            dt_day += datetime.timedelta(hours=24)
+        df = df[(dt_start <= df.date) & (df.date < dt_end)]
+
+    if tilekey and df is not None:
+        df = tile.index_by_tilekey(df)
+    return df
 
 
 def test():
@@ -57,11 +57,9 @@ def tiles(target_prefecture: str, zoom: int) -> pd.DataFrame:
     if target_prefecture not in Neighbors:  # 神奈川以外はまだ動かない
         return None
 
-    # 地理院メッシュの間隔
-    pref_range = np.array(prefecture_ranges[target_prefecture])  # lon,lat
-    tiles, _ = tile.tiles(zoom, pref_range)
-
-    lonlats = tile.lonlat(xy=tiles, zoom=zoom)
+    # 地理院メッシュ
+    grid = tile.grid(target_prefecture, zoom)
+    lonlats = grid.lonlats[grid.active]
 
     # OpenWeathermapのOne Call APIには時刻指定がない。
     # つまり、同じURLでも、アクセスする時刻によって内容が変化する。
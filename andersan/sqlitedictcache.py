@@ -1,4 +1,4 @@
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from collections.abc import Callable
 from typing import Final, Generic, Hashable, NamedTuple, Optional, ParamSpec, TypeVar
 from logging import getLogger
@@ -10,36 +10,924 @@ P = ParamSpec("P")
 # sqlitedict cache
 import sqlitedict
 import json
+import asyncio
+import atexit
+import contextlib
+import copy
+import datetime
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# basenameごとに開きっぱなしにするSqliteDict。
+# 毎回open/closeするとファイルのオープンとスキーマ確認のほうが検索より重くなるので、
+# プロセス内で1つの接続を共有する。SqliteDictは内部の専用スレッドで要求を直列化するので、
+# 複数スレッドから同じインスタンスを使ってよい。
+_shelves: dict[str, sqlitedict.SqliteDict] = {}
+_shelves_lock = threading.Lock()
+
+
+# 値のエンコード。
+# DataFrameはArrow IPC(file形式)でも保存できる。pandasの版に依存しないが、読み出しはpickleより遅い
+# (benchmark_codec参照)ので、既定はpickle。Arrow IPC fileは必ずb"ARROW1"で始まり、
+# pickle(protocol>=2)はb"\x80"で始まるので、先頭を見ればどちらか区別できる。
+# これにより、既存のpickleのエントリとArrowのエントリが同じファイルに共存できる。
+ARROW_MAGIC: Final = b"ARROW1"
+
+
+class _ArrowIPC(bytes):
+    """Arrow IPCにエンコード済みの値。_encodeはこれをそのまま保存する。"""
+
+
+def _to_arrow(value) -> _ArrowIPC | None:
+    """DataFrameをArrow IPCにする。DataFrameでない、あるいは変換できなければNone。"""
+    import pandas as pd
+    import pyarrow as pa
+
+    if not isinstance(value, pd.DataFrame):
+        return None
+    try:
+        table = pa.Table.from_pandas(value)
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        getLogger().info(
+            f"Cannot encode DataFrame with Arrow; falling back to pickle: {e}"
+        )
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return _ArrowIPC(sink.getvalue().to_pybytes())
+
+
+def _from_arrow(blob):
+    import pyarrow as pa
+
+    table = pa.ipc.open_file(pa.py_buffer(blob)).read_all()
+    # split_blocksで列ごとにArrowのバッファをそのまま使う(zero-copy)と読み出し専用になり、
+    # メモリやpickleから返る値と違って呼び出し元が書きかえられない。1回だけ複製して書きこめるようにする。
+    return table.to_pandas(split_blocks=True).copy()
+
+
+def _encode(value):
+    if isinstance(value, _ArrowIPC):
+        return sqlite3.Binary(value)
+    return sqlitedict.encode(value)
+
+
+def _decode(blob):
+    if bytes(blob[: len(ARROW_MAGIC)]) == ARROW_MAGIC:
+        return _from_arrow(blob)
+    return sqlitedict.decode(blob)
+
+
+def _shelf(basename: str) -> sqlitedict.SqliteDict:
+    """basenameに対応する長寿命のSqliteDictを返す。なければWALモードで開く。"""
+    with _shelves_lock:
+        shelf = _shelves.get(basename)
+        if shelf is None:
+            shelf = sqlitedict.SqliteDict(
+                f"{basename}.sqlite",
+                journal_mode="WAL",  # 読み手が書き手を待たない
+                outer_stack=False,  # 要求ごとにstackを記録しない(速い)
+                encode=_encode,
+                decode=_decode,
+            )
+            _init_meta(shelf)
+            _shelves[basename] = shelf
+        return shelf
+
+
+def close_all():
+    """開いているキャッシュファイルをすべて閉じる。終了時に自動で呼ばれる。"""
+    with _shelves_lock:
+        while _shelves:
+            _, shelf = _shelves.popitem()
+            _flush_access(shelf)
+            shelf.close()
+
+
+atexit.register(close_all)
+
+
+def _after_fork_in_child():
+    """fork()した子プロセスには親のSqliteDictの専用スレッドがないので、親の接続を使うと止まる。
+    閉じずに(閉じるのも専用スレッドの仕事)忘れて、子は自分で開きなおす。"""
+    global _shelves, _shelves_lock, _accessed_lock, _ranges_lock
+    _shelves = {}
+    _shelves_lock = threading.Lock()
+    _accessed.clear()
+    _accessed_lock = threading.Lock()
+    # fcntlのロックはforkで引き継がれない。ロックファイルのfdはそのまま使える。
+    _ranges.clear()
+    _ranges_lock = threading.Lock()
+    _releasing.clear()
+    # 関数ごとのロックも、forkの瞬間に親のほかのスレッドが持っていたかもしれない
+    for wrapper in list(_wrappers):
+        wrapper._after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def migrate_to_arrow(basename: str) -> int:
+    """既存の{basename}.sqliteのうち、pickleで保存されたDataFrameをArrow IPCに書きかえる。
+
+    Returns:
+        int: 書きかえたエントリの数
+    """
+    logger = getLogger()
+    shelf = _shelf(basename)
+    count = 0
+    for key in list(shelf.keys()):
+        value = shelf[key]
+        encoded = _to_arrow(value)
+        if encoded is None:
+            continue
+        shelf[key] = encoded
+        count += 1
+        if count % 100 == 0:
+            shelf.commit()
+    shelf.conn.execute(
+        f'UPDATE {_META} SET size = (SELECT length(value) FROM "{shelf.tablename}" AS t '
+        f"WHERE t.key = {_META}.key)"
+    )
+    shelf.commit()
+    logger.info(f"Migrated {count} entries of {basename} to Arrow IPC.")
+    return count
+
+
+# 有効期限と容量。
+# 値のテーブルとは別に、キーごとの作成時刻・最終アクセス時刻・大きさを同じファイルに記録し、
+# これを見て期限切れのものや長く使われていないものを捨てる。
+_META: Final = "cache_meta"
+# Noneを返した呼び出しの記録(tombstone)。値のテーブルとは別にし、短い有効期間で使う。
+_NEGATIVE: Final = "cache_negative"
+_MISSING: Final = object()
+# ファイルごとの、まだ書いていない最終アクセス時刻 {key: time}
+_accessed: dict[str, dict[str, float]] = {}
+_accessed_lock = threading.Lock()
+
+
+def _init_meta(shelf: sqlitedict.SqliteDict) -> None:
+    conn = shelf.conn
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {_META} "
+        "(key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER)"
+    )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {_META}_accessed ON {_META} (accessed)")
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {_NEGATIVE} (key TEXT PRIMARY KEY, created REAL)"
+    )
+    # メタデータのない既存のエントリは、いま作られたことにする。
+    # length()はBLOBの中身を読まないので、大きいファイルでも速い。
+    now = time.time()
+    conn.execute(
+        f"INSERT OR IGNORE INTO {_META} (key, created, accessed, size) "
+        f'SELECT key, ?, ?, length(value) FROM "{shelf.tablename}"',
+        (now, now),
+    )
+    shelf.commit()
+
+
+def _rename(shelf: sqlitedict.SqliteDict, old: str, new: str) -> bool:
+    """値を読まずにキーだけ付けかえる。oldがなければFalse。"""
+    if (
+        shelf.conn.select_one(
+            f'SELECT 1 FROM "{shelf.tablename}" WHERE key = ?', (old,)
+        )
+        is None
+    ):
+        return False
+    shelf.conn.execute(
+        f'REPLACE INTO "{shelf.tablename}" (key, value) '
+        f'SELECT ?, value FROM "{shelf.tablename}" WHERE key = ?',
+        (new, old),
+    )
+    shelf.conn.execute(
+        f"UPDATE OR REPLACE {_META} SET key = ? WHERE key = ?", (new, old)
+    )
+    shelf.conn.execute(f'DELETE FROM "{shelf.tablename}" WHERE key = ?', (old,))
+    shelf.commit()
+    return True
+
+
+# キャッシュのキー。
+# 引数をシグネチャに束縛して既定値を補い、引数名でソートしたJSONにしてからハッシュする。
+# こうすると tiles_("kanagawa", d, 12) と tiles_("kanagawa", d, zoom=12) が同じキーになり、
+# 既定値の変更もキーに反映され、キーの長さも一定になる。
+def _canonical(func: Callable, args: tuple, kwargs: dict, version=None) -> str:
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return json.dumps(
+        [version, bound.arguments],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=_jsonable,
+    )
+
+
+def _jsonable(o):
+    """json.dumpsが扱えない引数をキーにする。str()は大きい配列を...で省略し、
+    アドレス入りのreprはプロセスごとに変わるので、知らない型はTypeErrorにする。"""
+    if isinstance(o, (datetime.date, datetime.time, datetime.timedelta)):
+        return str(o)  # 既存のキーと同じ
+    if isinstance(o, (set, frozenset)):
+        return sorted(o, key=repr)
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None:
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, np.ndarray):
+            if o.dtype.hasobject:
+                return o.tolist()
+            data = np.ascontiguousarray(o)
+            return {
+                "ndarray": str(data.dtype),
+                "shape": list(data.shape),
+                "blake2b": hashlib.blake2b(data.tobytes(), digest_size=16).hexdigest(),
+            }
+    raise TypeError(f"Cannot make a cache key from {type(o).__name__}")
+
+
+def _hashed(canonical: str) -> str:
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def _legacy_key(args: tuple, kwargs: dict) -> str | None:
+    """旧形式のキー。JSONにできない引数なら旧形式でも保存されていないのでNone。"""
+    try:
+        return json.dumps(args + tuple(kwargs.items()))
+    except TypeError:
+        return None
+
+
+def _seconds(ttl) -> float | None:
+    """ttlは秒数かdatetime.timedelta。"""
+    if ttl is None:
+        return None
+    if hasattr(ttl, "total_seconds"):
+        return ttl.total_seconds()
+    return float(ttl)
+
+
+def _lookup(shelf: sqlitedict.SqliteDict, key: str, ttl: float | None):
+    """keyの値を返す。ない、あるいは期限切れなら_MISSING。"""
+    now = time.time()
+    if ttl is not None:
+        row = shelf.conn.select_one(
+            f"SELECT created FROM {_META} WHERE key = ?", (key,)
+        )
+        if row is not None and row[0] + ttl < now:
+            _delete(shelf, [key])
+            shelf.commit()
+            return _MISSING
+    try:
+        value = shelf[key]
+    except KeyError:
+        return _MISSING
+    # ヒットのたびに書くと書き込みのトランザクションが開いたままになり、
+    # ほかのプロセスが書けなくなる。メモリに溜めて、_flush_accessでまとめて書く。
+    with _accessed_lock:
+        _accessed.setdefault(shelf.filename, {})[key] = now
+    return value
+
+
+def _flush_access(shelf: sqlitedict.SqliteDict) -> None:
+    """溜めておいた最終アクセス時刻を書いてcommitする。"""
+    with _accessed_lock:
+        pending = _accessed.pop(shelf.filename, None)
+    if pending:
+        shelf.conn.executemany(
+            f"UPDATE {_META} SET accessed = ? WHERE key = ?",
+            [(t, key) for key, t in pending.items()],
+        )
+    shelf.commit()
+
+
+def _created(shelf: sqlitedict.SqliteDict, key: str) -> float | None:
+    row = shelf.conn.select_one(f"SELECT created FROM {_META} WHERE key = ?", (key,))
+    return None if row is None else row[0]
+
+
+def _store(shelf: sqlitedict.SqliteDict, key: str, value) -> None:
+    now = time.time()
+    shelf[key] = value
+    shelf.conn.execute(
+        f"REPLACE INTO {_META} (key, created, accessed, size) "
+        f'SELECT key, ?, ?, length(value) FROM "{shelf.tablename}" WHERE key = ?',
+        (now, now, key),
+    )
+
+
+def _negative_hit(shelf: sqlitedict.SqliteDict, key: str, ttl: float) -> bool:
+    """keyについて、有効期間内のtombstoneがあればTrue。"""
+    row = shelf.conn.select_one(
+        f"SELECT created FROM {_NEGATIVE} WHERE key = ?", (key,)
+    )
+    return row is not None and time.time() <= row[0] + ttl
+
+
+def _store_negative(shelf: sqlitedict.SqliteDict, key: str) -> None:
+    shelf.conn.execute(
+        f"REPLACE INTO {_NEGATIVE} (key, created) VALUES (?, ?)", (key, time.time())
+    )
+
+
+def _delete(shelf: sqlitedict.SqliteDict, keys: list[str]) -> None:
+    rows = [(key,) for key in keys]
+    shelf.conn.executemany(f'DELETE FROM "{shelf.tablename}" WHERE key = ?', rows)
+    shelf.conn.executemany(f"DELETE FROM {_META} WHERE key = ?", rows)
+
+
+def _expire(shelf: sqlitedict.SqliteDict, ttl: float) -> int:
+    limit = time.time() - ttl
+    keys = [
+        key
+        for (key,) in shelf.conn.select(
+            f"SELECT key FROM {_META} WHERE created < ?", (limit,)
+        )
+    ]
+    _delete(shelf, keys)
+    return len(keys)
+
+
+def _evict(
+    shelf: sqlitedict.SqliteDict, max_bytes: int | None, max_entries: int | None
+) -> int:
+    """最終アクセスの古いものから、容量とエントリ数が上限に収まるまで捨てる。"""
+    entries, nbytes = shelf.conn.select_one(
+        f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {_META}"
+    )
+    keys = []
+    if (max_entries is None or entries <= max_entries) and (
+        max_bytes is None or nbytes <= max_bytes
+    ):
+        return 0
+    for key, size in shelf.conn.select(
+        f"SELECT key, size FROM {_META} ORDER BY accessed"
+    ):
+        if (max_entries is None or entries <= max_entries) and (
+            max_bytes is None or nbytes <= max_bytes
+        ):
+            break
+        keys.append(key)
+        entries -= 1
+        nbytes -= size or 0
+    _delete(shelf, keys)
+    return len(keys)
+
+
+def compact(
+    basename: str,
+    max_bytes: int | None = None,
+    max_entries: int | None = None,
+    ttl=None,
+    vacuum: bool = True,
+    negative_ttl=None,
+) -> int:
+    """{basename}.sqliteから期限切れと容量超過のエントリを捨て、必要ならVACUUMする。
+
+    Args:
+        basename (str): キャッシュファイルの名前(拡張子なし)
+        max_bytes (int, optional): 値の大きさの合計の上限
+        max_entries (int, optional): エントリ数の上限
+        ttl (float | datetime.timedelta, optional): 作成からの有効期間(秒)
+        vacuum (bool, optional): 捨てたあとでファイルを詰める。
+        negative_ttl (float | datetime.timedelta, optional): これより古いtombstoneを捨てる。
+
+    Returns:
+        int: 捨てたエントリの数
+    """
+    logger = getLogger()
+    shelf = _shelf(basename)
+    _flush_access(shelf)
+    # 値のないメタデータ(外から消されたもの)を掃除する
+    shelf.conn.execute(
+        f'DELETE FROM {_META} WHERE key NOT IN (SELECT key FROM "{shelf.tablename}")'
+    )
+    removed = 0
+    ttl = _seconds(ttl)
+    if ttl is not None:
+        removed += _expire(shelf, ttl)
+    removed += _evict(shelf, max_bytes, max_entries)
+    negative_ttl = _seconds(negative_ttl)
+    if negative_ttl is not None:
+        shelf.conn.execute(
+            f"DELETE FROM {_NEGATIVE} WHERE created < ?", (time.time() - negative_ttl,)
+        )
+    shelf.commit()
+    if vacuum:
+        # VACUUMはトランザクションの外でしか実行できないが、共有の接続ではほかのスレッドが
+        # 書いている最中かもしれない。別の短命な接続で、書き込みが終わるのを待ってから実行する。
+        conn = sqlite3.connect(shelf.filename, timeout=60, isolation_level=None)
+        try:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    logger.info(f"Compacted {basename}: removed {removed} entries.")
+    return removed
+
+
+def start_compaction(basename: str, interval: float, **policy) -> threading.Event:
+    """interval秒ごとにcompact(basename, **policy)を呼ぶdaemonスレッドを起動する。
+
+    Returns:
+        threading.Event: setするとスレッドが止まる。
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                compact(basename, **policy)
+            except Exception as e:
+                getLogger().warning(f"Compaction of {basename} failed: {e}")
+
+    threading.Thread(target=run, name=f"compact-{basename}", daemon=True).start()
+    return stop
+
+
+def _sizeof(value) -> int:
+    """メモリ上の大きさ(bytes)の見積もり。"""
+    if hasattr(value, "memory_usage"):  # pandas.DataFrame / Series
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    if hasattr(value, "nbytes"):  # numpy.ndarray
+        return int(value.nbytes)
+    return len(pickle.dumps(value))
+
+
+def _copy(value):
+    """呼び出し元が書きかえてもキャッシュが汚れないように複製する。
+    DataFrameやndarrayはバッファのコピーだけなので、unpickleよりずっと安い。"""
+    if hasattr(value, "copy"):
+        return value.copy()
+    return copy.deepcopy(value)
+
+
+class _MemoryLRU:
+    """プロセス内のLRUキャッシュ。大きさの合計がmax_bytesを越えたら古いものから捨てる。"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # key: (値, 大きさ, 作成時刻)
+        self._items: OrderedDict[str, tuple[object, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, ttl: float | None = None):
+        """keyがない、あるいは作成からttl秒を過ぎていればKeyErrorを投げる。"""
+        with self._lock:
+            value, size, created = self._items[key]
+            if ttl is not None and created + ttl < time.time():
+                del self._items[key]
+                self.nbytes -= size
+                raise KeyError(key)
+            self._items.move_to_end(key)
+        return _copy(value)
+
+    def put(self, key: str, value, created: float | None = None) -> None:
+        """createdは値が作られた時刻(ファイルから読んだ値ならその作成時刻)。省略するといま。"""
+        if created is None:
+            created = time.time()
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            # 1つで予算を越えるものは置かない
+            return
+        value = _copy(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size, created)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted, _) = self._items.popitem(last=False)
+                self.nbytes -= evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def _after_fork_in_child(self) -> None:
+        # 書きかけだったかもしれないので、中身も捨てる
+        self._lock = threading.Lock()
+        self._items.clear()
+        self.nbytes = 0
+
+
+# 同じキーの同時ミスをまとめる(single-flight)。
+# プロセス内では、最初にミスしたスレッドだけが計算し、ほかのスレッドはその結果を待つ。
+# プロセス間では、{basename}.sqlite.lock のキーごとのバイト範囲をfcntlでロックし、
+# ロックを取ったあとでもう一度キャッシュを見る。待っていたプロセスは先行者の結果を読むだけになる。
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+# fcntlのロックはプロセスのもので、そのファイルのどのfdを閉じてもプロセスのロックが全部外れる。
+# そこでロックファイルはbasenameごとに1つだけ開き、プロセスが終わるまで閉じない。
+# 同じプロセスのスレッドどうしはfcntlでは排他されないので、バイト範囲ごとのthreading.Lockで排他する。
+_lockfiles: dict[str, object] = {}
+_ranges: dict[tuple[str, int], "_Range"] = {}
+_ranges_lock = threading.Lock()
+
+
+class _Range:
+    """プロセス内でバイト範囲を持っている者(owner)と、その入れ子の深さ。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.owner = None
+        self.depth = 0
+
+
+@contextlib.contextmanager
+def _process_lock(basename: str, key: str, owner=None):
+    """keyのバイト範囲をロックする。ownerが同じなら入れ子にしてよい(再帰呼び出し)。
+    ownerの既定値はスレッド。asyncではタスクを渡す(入るときと出るときでスレッドが違う)。"""
+    if fcntl is None:
+        yield
+        return
+    if owner is None:
+        owner = threading.get_ident()
+    # 32bitのオフセットに落とす。衝突しても、別のキーどうしが直列になるだけ。
+    offset = int(key[:8], 16)
+    with _ranges_lock:
+        f = _lockfiles.get(basename)
+        if f is None:
+            f = _lockfiles[basename] = open(f"{basename}.sqlite.lock", "a")
+        held = _ranges.setdefault((basename, offset), _Range())
+        held.users += 1
+    try:
+        if held.owner != owner:
+            held.lock.acquire()
+            held.owner = owner
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX, 1, offset)
+            except BaseException:
+                held.owner = None
+                held.lock.release()
+                raise
+        held.depth += 1
+        try:
+            yield
+        finally:
+            held.depth -= 1
+            if held.depth == 0:
+                fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+                held.owner = None
+                held.lock.release()
+    finally:
+        with _ranges_lock:
+            held.users -= 1
+            if held.users == 0:
+                del _ranges[(basename, offset)]
+
+
+# fork()した子でロックを作りなおすために、すべてのwrapperを覚えておく
+_wrappers: "weakref.WeakSet[_SQLiteDictCacheFunctionWrapper]" = weakref.WeakSet()
 
 
 class _SQLiteDictCacheFunctionWrapper(Generic[P, T]):
-    def __init__(self, func: Callable[P, T], basename: str):
+    def __init__(
+        self,
+        func: Callable[P, T],
+        basename: str,
+        memory_bytes: int = 0,
+        codec: str = "pickle",
+        max_bytes: int | None = None,
+        max_entries: int | None = None,
+        ttl=None,
+        version=None,
+        negative_ttl=None,
+    ):
+        if codec not in ("pickle", "arrow"):
+            raise ValueError(f"codec must be 'pickle' or 'arrow', got {codec}")
         self.__wrapped__ = func
         self.__basename = basename
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = _seconds(ttl)
+        self.version = version
+        self.negative_ttl = _seconds(negative_ttl)
+        # ヒット・ミスの回数
+        self.stats: Counter[str] = Counter()
+        self._stats_lock = threading.Lock()
+        # memory_bytes > 0 のとき、SQLiteの手前にプロセス内LRUを置く。
+        self.memory = _MemoryLRU(memory_bytes) if memory_bytes > 0 else None
+        self._flights: dict[str, _Flight] = {}
+        self._flights_lock = threading.Lock()
+        _wrappers.add(self)
+
+    def _after_fork_in_child(self) -> None:
+        """親で計算中だった呼び出しは子では終わらないので、待たずに忘れる。"""
+        self._stats_lock = threading.Lock()
+        if self.memory is not None:
+            self.memory._after_fork_in_child()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    @property
+    def basename(self) -> str:
+        return self.__basename
 
     def __call__(self, *args: P.args, **kwargs: P.kwargs) -> T:
+        call_args = self._key(args, kwargs)
+        ret = self._from_memory(call_args)
+        if ret is not _MISSING:
+            return ret
+        shelf = _shelf(self.__basename)
+        ret = self._cached(shelf, call_args, args, kwargs)
+        if ret is _MISSING:
+            ret = self._single_flight(shelf, call_args, args, kwargs)
+        if self.memory is not None and ret is not None:
+            self.memory.put(call_args, ret, self._created(shelf, call_args))
+        return ret
+
+    def _key(self, args, kwargs) -> str:
+        canonical = _canonical(self.__wrapped__, args, kwargs, self.version)
+        getLogger().debug(canonical)
+        return _hashed(canonical)
+
+    def _from_memory(self, call_args: str):
+        if self.memory is None:
+            return _MISSING
+        try:
+            ret = self.memory.get(call_args, self.ttl)
+        except KeyError:
+            return _MISSING
+        getLogger().debug(f"Memory cache hit for {self.__basename}.")
+        self._count("memory_hits")
+        return ret
+
+    def _cached(self, shelf, call_args: str, args, kwargs):
+        """ファイルにある値を返す。tombstoneがあればNone、なにもなければ_MISSING。"""
         logger = getLogger()
-        call_args = json.dumps(args + tuple(kwargs.items()))
-        logger.debug(call_args)
-        with sqlitedict.open(f"{self.__basename}.sqlite") as shelf:
-            if call_args not in shelf:
-                ret = self.__wrapped__(*args, **kwargs)
-                if ret is None:
-                    logger.info(f"Cache for {self.__basename} prevents storing None.")
-                else:
-                    shelf[call_args] = ret
-                    shelf.commit()
-            else:
-                logger.debug(f"Cache hit for {self.__basename}.")
-                ret = shelf[call_args]
+        ret = _lookup(shelf, call_args, self.ttl)
+        if ret is _MISSING and self.version is None:
+            # 旧形式のキーで保存されていれば、新しいキーに付けかえて使う
+            legacy = _legacy_key(args, kwargs)
+            if legacy is not None and _rename(shelf, legacy, call_args):
+                logger.info(f"Migrated legacy cache key of {self.__basename}.")
+                ret = _lookup(shelf, call_args, self.ttl)
+        if ret is not _MISSING:
+            logger.debug(f"Cache hit for {self.__basename}.")
+            self._count("hits")
+        elif self.negative_ttl is not None and _negative_hit(
+            shelf, call_args, self.negative_ttl
+        ):
+            logger.debug(f"Negative cache hit for {self.__basename}.")
+            self._count("negative_hits")
+            ret = None
+        return ret
+
+    def _recheck(self, shelf, call_args: str):
+        """ロックを待つあいだに別のプロセスが保存したかもしれないので、もう一度見る。"""
+        ret = _lookup(shelf, call_args, self.ttl)
+        if ret is _MISSING and self.negative_ttl is not None:
+            if _negative_hit(shelf, call_args, self.negative_ttl):
+                ret = None
+        if ret is _MISSING:
+            self._count("misses")
         return ret
 
+    def _save(self, shelf, call_args: str, ret) -> None:
+        if ret is None and self.negative_ttl is not None:
+            _store_negative(shelf, call_args)
+            shelf.commit()
+            self._count("negative_stores")
+        elif ret is None:
+            getLogger().info(f"Cache for {self.__basename} prevents storing None.")
+        else:
+            _store(shelf, call_args, self._encoded(ret))
+            if self.max_bytes is not None or self.max_entries is not None:
+                # LRUの順序が正しくなるように、最終アクセス時刻を先に書く
+                _flush_access(shelf)
+                _evict(shelf, self.max_bytes, self.max_entries)
+            _flush_access(shelf)
+
+    def _single_flight(self, shelf, call_args: str, args, kwargs):
+        """同じキーの計算が進行中ならその結果を待ち、なければ自分で計算して保存する。"""
+        with self._flights_lock:
+            flight = self._flights.get(call_args)
+            leader = flight is None
+            if leader:
+                flight = self._flights[call_args] = _Flight()
+        if not leader:
+            getLogger().debug(f"Waiting for in-flight call of {self.__basename}.")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return None if flight.result is None else _copy(flight.result)
+
+        try:
+            with _process_lock(self.__basename, call_args):
+                ret = self._recheck(shelf, call_args)
+                if ret is _MISSING:
+                    ret = self.__wrapped__(*args, **kwargs)
+                    self._save(shelf, call_args, ret)
+            flight.result = ret
+            return ret
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[call_args]
+            flight.done.set()
+
+    def _created(self, shelf, call_args: str) -> float | None:
+        """ファイルでの作成時刻。メモリに置いた値もファイルと同じ時刻に期限切れにする。"""
+        if self.ttl is None:
+            return None
+        return _created(shelf, call_args)
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _encoded(self, value):
+        if self.codec == "arrow":
+            encoded = _to_arrow(value)
+            if encoded is not None:
+                return encoded
+        return value
+
+    def compact(self, vacuum: bool = True) -> int:
+        """デコレータに指定した期限と容量にしたがってキャッシュファイルを整理する。"""
+        return compact(
+            self.__basename,
+            max_bytes=self.max_bytes,
+            max_entries=self.max_entries,
+            ttl=self.ttl,
+            vacuum=vacuum,
+            negative_ttl=self.negative_ttl,
+        )
+
 
 def sqlitedict_cache(
     basename: str,
+    memory_bytes: int = 0,
+    codec: str = "pickle",
+    max_bytes: int | None = None,
+    max_entries: int | None = None,
+    ttl=None,
+    version=None,
+    negative_ttl=None,
 ) -> Callable[[Callable[P, T]], _SQLiteDictCacheFunctionWrapper[P, T]]:
+    """関数の結果を{basename}.sqliteに保存するデコレータ。
+
+    Args:
+        basename (str): キャッシュファイルの名前(拡張子なし)
+        memory_bytes (int, optional): プロセス内LRUの容量(bytes)。0なら使わない。
+        codec (str, optional): "arrow"ならDataFrameをArrow IPCで保存する。
+            "pickle"(既定)なら従来どおり。読み出しはどちらの形式も受けつける。
+        max_bytes (int, optional): ファイル内の値の大きさの合計の上限。
+            越えたら最終アクセスの古いものから捨てる。
+        max_entries (int, optional): エントリ数の上限。
+        ttl (float | datetime.timedelta, optional): 作成からの有効期間(秒)。
+            過ぎたものはヒットしない。
+        version (optional): キーに混ぜる値。関数の中身を変えたときに変えれば、
+            古い結果を使わなくなる。
+        negative_ttl (float | datetime.timedelta, optional): Noneを返した呼び出しを
+            この期間(秒)だけ覚えておき、再計算せずにNoneを返す。既定では覚えない。
+    """
+
     def decorator(func: Callable[P, T]) -> _SQLiteDictCacheFunctionWrapper[P, T]:
-        wrapped = _SQLiteDictCacheFunctionWrapper(func, basename)
+        wrapped = _SQLiteDictCacheFunctionWrapper(
+            func,
+            basename,
+            memory_bytes=memory_bytes,
+            codec=codec,
+            max_bytes=max_bytes,
+            max_entries=max_entries,
+            ttl=ttl,
+            version=version,
+            negative_ttl=negative_ttl,
+        )
+        wrapped.__doc__ = func.__doc__
+        return wrapped
+
+    return decorator
+
+
+class _AsyncSQLiteDictCacheFunctionWrapper(_SQLiteDictCacheFunctionWrapper):
+    """coroutine関数用。SQLiteの読み書きはスレッドで行い、イベントループを止めない。
+    ファイルの形式とキーは同期版と同じなので、同期と非同期の呼び出し元でキャッシュを共有できる。"""
+
+    def __init__(self, func, basename: str, **options):
+        super().__init__(func, basename, **options)
+        self._async_flights: dict[str, asyncio.Future] = {}
+
+    def _after_fork_in_child(self) -> None:
+        super()._after_fork_in_child()
+        # 親のイベントループのFutureは子では使えない
+        self._async_flights = {}
+
+    async def __call__(self, *args, **kwargs):
+        call_args = self._key(args, kwargs)
+        ret = self._from_memory(call_args)
+        if ret is not _MISSING:
+            return ret
+        shelf = await asyncio.to_thread(_shelf, self.basename)
+        ret = await asyncio.to_thread(self._cached, shelf, call_args, args, kwargs)
+        if ret is _MISSING:
+            ret = await self._single_flight_async(shelf, call_args, args, kwargs)
+        if self.memory is not None and ret is not None:
+            created = await asyncio.to_thread(self._created, shelf, call_args)
+            self.memory.put(call_args, ret, created)
+        return ret
+
+    async def _single_flight_async(self, shelf, call_args: str, args, kwargs):
+        """同じキーのawaitが進行中ならその結果を待ち、なければ自分で計算して保存する。"""
+        flight = self._async_flights.get(call_args)
+        if flight is not None:
+            getLogger().debug(f"Waiting for in-flight call of {self.basename}.")
+            ret = await asyncio.shield(flight)
+            return None if ret is None else _copy(ret)
+
+        flight = self._async_flights[call_args] = (
+            asyncio.get_running_loop().create_future()
+        )
+        lock = _process_lock(self.basename, call_args, owner=asyncio.current_task())
+        try:
+            await _enter_lock(lock)
+            try:
+                ret = await asyncio.to_thread(self._recheck, shelf, call_args)
+                if ret is _MISSING:
+                    ret = await self.__wrapped__(*args, **kwargs)
+                    await asyncio.to_thread(self._save, shelf, call_args, ret)
+            finally:
+                # 取消されても、ロックは必ず外す
+                await asyncio.shield(asyncio.to_thread(lock.__exit__, None, None, None))
+            flight.set_result(ret)
+            return ret
+        except BaseException as e:
+            flight.set_exception(e)
+            # 待っている者がいなくても警告が出ないように、例外を取り出しておく
+            flight.exception()
+            raise
+        finally:
+            del self._async_flights[call_args]
+
+
+# ロック待ちのあいだに取消されたタスクのかわりにロックを外すタスク(GCされないように持っておく)
+_releasing: set = set()
+
+
+async def _enter_lock(lock) -> None:
+    """lockをスレッドで取る。待っているあいだに取消されても、スレッドはいずれロックを取るので、
+    取れたところで外すタスクを残してから取消を伝える。"""
+    enter = asyncio.ensure_future(asyncio.to_thread(lock.__enter__))
+    try:
+        await asyncio.shield(enter)
+    except asyncio.CancelledError:
+
+        async def release():
+            try:
+                await enter
+            except BaseException:
+                return  # 取れなかった
+            await asyncio.to_thread(lock.__exit__, None, None, None)
+
+        task = asyncio.ensure_future(release())
+        _releasing.add(task)
+        task.add_done_callback(_releasing.discard)
+        raise
+
+
+def async_sqlitedict_cache(
+    basename: str, **options
+) -> Callable[[Callable], _AsyncSQLiteDictCacheFunctionWrapper]:
+    """coroutine関数の結果を{basename}.sqliteに保存するデコレータ。
+    optionsはsqlitedict_cacheと同じ。"""
+
+    def decorator(func: Callable) -> _AsyncSQLiteDictCacheFunctionWrapper:
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError(f"{func.__name__} is not a coroutine function")
+        wrapped = _AsyncSQLiteDictCacheFunctionWrapper(func, basename, **options)
         wrapped.__doc__ = func.__doc__
         return wrapped
 
@@ -65,5 +953,79 @@ def fib(n):
     return 1 if n in (0, 1) else fib(n - 1) + fib(n - 2)
 
 
+def benchmark(n: int = 1000, basename: str = "benchmark_sqlitedictcache"):
+    """キャッシュヒット1回あたりの時間を、毎回開く旧方式と開きっぱなしの新方式で比べる。"""
+    import pandas as pd
+    import numpy as np
+
+    call_args = json.dumps(("kanagawa", "2025-02-20", 12))
+    value = pd.DataFrame(np.random.random((24 * 150, 10)))
+    with sqlitedict.open(f"{basename}.sqlite", journal_mode="WAL") as shelf:
+        shelf[call_args] = value
+        shelf.commit()
+
+    # 旧方式: 呼び出しのたびにopen/close
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with sqlitedict.open(f"{basename}.sqlite") as shelf:
+            if call_args in shelf:
+                shelf[call_args]
+    reopen = (time.perf_counter() - t0) / n
+
+    # 新方式: 開きっぱなし
+    shelf = _shelf(basename)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        if call_args in shelf:
+            shelf[call_args]
+    persistent = (time.perf_counter() - t0) / n
+
+    print(f"reopen:     {reopen * 1e6:8.1f} us/hit")
+    print(f"persistent: {persistent * 1e6:8.1f} us/hit")
+    return reopen, persistent
+
+
+def benchmark_codec(
+    n: int = 20,
+    rows: tuple[int, ...] = (24 * 100, 24 * 10000),
+    basename: str = "benchmark_sqlitedictcache",
+):
+    """DataFrameの読み出し時間をpickleとArrow IPCで比べる。
+    小さいDataFrameではto_pandas()の固定費(1ms弱)のぶんpickleが速い。
+    また、読み出した表を書きこめるように複製するので、大きい表でもpickleより速くはならない。"""
+    import pandas as pd
+    import numpy as np
+
+    shelf = _shelf(basename)
+    results = {}
+    for nrows in rows:
+        value = pd.DataFrame(
+            {
+                "date": pd.date_range(
+                    "2025-02-20", periods=nrows, freq="min", tz="Asia/Tokyo"
+                ),
+                "X": np.random.randint(3600, 3700, nrows),
+                "Y": np.random.randint(1600, 1700, nrows),
+                "Z": 12,
+            }
+            | {f"item{i}": np.random.random(nrows) for i in range(6)}
+        )
+        shelf["pickle"] = value
+        shelf["arrow"] = _to_arrow(value)
+        shelf.commit()
+
+        for key in ("pickle", "arrow"):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                shelf[key]
+            results[nrows, key] = (time.perf_counter() - t0) / n
+            print(
+                f"{nrows:8d} rows, {key:6s}: {results[nrows, key] * 1e3:8.2f} ms/load"
+            )
+    return results
+
+
 if __name__ == "__main__":
     print(fib(40))
+    benchmark()
+    benchmark_codec()
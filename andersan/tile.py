@@ -2,8 +2,19 @@
 地理院タイルの操作。
 """
 
+import os
+import json
+import hashlib
 import numpy as np
+from functools import lru_cache
 from logging import getLogger, DEBUG, basicConfig
+from dataclasses import dataclass
+
+try:
+    from andersan import prefecture_ranges
+except:
+    # for test()
+    from __init__ import prefecture_ranges
 
 
 # backward compat
@@ -33,6 +44,7 @@ def get_tile_bbox(z, x, y):
 def get_tile_approximate_lonlats(z, x, y):
     """
     タイルの各ピクセルの左上隅の経度緯度を取得する（簡易版）
+    正確な値はpixel_lonlats()で得られる。
     Parameters
     ----------
     z : int
@@ -59,13 +71,8 @@ def get_tile_approximate_lonlats(z, x, y):
     height_per_px = height / 256
 
     lonlats = np.zeros((256, 256, 2))
-    lat = bbox[3]
-    for i in range(256):
-        lon = bbox[0]
-        for j in range(256):
-            lonlats[i, j, :] = [lon, lat]
-            lon += width_per_px
-        lat -= height_per_px
+    lonlats[:, :, 0] = bbox[0] + np.arange(256)[None, :] * width_per_px
+    lonlats[:, :, 1] = bbox[3] - np.arange(256)[:, None] * height_per_px
     return lonlats
 
 
@@ -136,9 +143,6 @@ def lonlat(zoom: int, x: int = None, y: int = None, xy=None):
     # 同時に指定したらエラーを吐いて止まる。
     assert not (x is None and xy is None)
 
-    # zoom値を、実際の比率に変換します。換算に必要です。
-    n = 2.0**zoom
-
     # 対が与えられた場合とarrayが与えられた場合で、あとの換算処理が同じになるように、データ形式を加工します。
 
     logger = getLogger()
@@ -148,7 +152,7 @@ def lonlat(zoom: int, x: int = None, y: int = None, xy=None):
             # 1次元整数なら、x,yを分離する
             if len(xy.shape) == 1:
                 logger.warning("andersan.tile.lonlat(): 8-digit code is deprecated.")
-                xy = np.array([(x // 10000, x % 10000) for x in xy])
+                xy = np.column_stack(np.divmod(xy, 10000))
             # 2次元ならx,yとする
             x, y = np.floor(xy[:, 0]), np.floor(xy[:, 1])
         else:
@@ -160,9 +164,7 @@ def lonlat(zoom: int, x: int = None, y: int = None, xy=None):
         x, y = np.floor(x), np.floor(y)
 
     # 換算計算。これは上のリンクのどちらかからもってきただけ。
-    lon_deg = x / n * 360.0 - 180.0
-    lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * y / n)))
-    lat_deg = np.degrees(lat_rad)
+    lon_deg, lat_deg = _lonlat(zoom, x, y)
 
     # 返り値の返し方も、対とアレイで別になります。
     if xy is not None:
@@ -173,6 +175,47 @@ def lonlat(zoom: int, x: int = None, y: int = None, xy=None):
     return lon_deg, lat_deg
 
 
+def _lonlat(zoom, x, y):
+    """小数を含むタイル座標(x, y)の経度緯度。切りすてないので、タイル内の任意の点に使える。"""
+    n = 2.0**zoom
+    lon_deg = x / n * 360.0 - 180.0
+    lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * y / n)))
+    lat_deg = np.degrees(lat_rad)
+    return lon_deg, lat_deg
+
+
+def pixel_lonlats(zoom, xy, resolution=256, dtype=np.float64, center=False):
+    """タイルをresolution×resolutionに分けた各ピクセルの経度緯度を、まとめて計算する。
+
+    経度はxだけ、緯度はyだけの関数なので、1次元で計算してから広げる。近似はしない。
+
+    Args:
+        zoom (int): タイルのズーム率
+        xy: タイル番号。[2]なら1枚、[N, 2]ならN枚
+        resolution (int, optional): 1辺の分割数。256なら地理院タイルのピクセル
+        dtype (optional): 返す配列の型。np.float32にすると半分の大きさになる。
+        center (bool, optional): Trueならピクセルの中心、Falseなら左上隅
+
+    Returns:
+        np.ndarray: [resolution, resolution, 2] (1枚) あるいは [N, resolution, resolution, 2]。
+            [..., i, j, :] はi行j列(北から、西から)の経度、緯度
+    """
+    xy = np.asarray(xy)
+    single = xy.ndim == 1
+    xy = xy.reshape(-1, 2).astype(float)
+    offsets = np.arange(resolution) / resolution
+    if center:
+        offsets += 0.5 / resolution
+    lon, _ = _lonlat(zoom, xy[:, 0, None] + offsets, 0)
+    _, lat = _lonlat(zoom, 0, xy[:, 1, None] + offsets)
+    lonlats = np.empty((len(xy), resolution, resolution, 2), dtype=dtype)
+    lonlats[..., 0] = lon[:, None, :]
+    lonlats[..., 1] = lat[:, :, None]
+    if single:
+        return lonlats[0]
+    return lonlats
+
+
 def bounding_box(zoom, x, y):
     """
     タイル座標からバウンディングボックスを取得する
@@ -225,6 +268,391 @@ def tiles(zoom, lonlat_range):
     return XY, np.array([maxY - minY + 1, maxX - minX + 1])
 
 
+# 64bitのタイルキー。
+# 上位6bitにzoom、下位58bitにyとxのbitを交互に並べる(Morton順)。yのbitを上にしているので、
+# 下位bitを2bitずつ区切って読むとquadkeyの各桁(0-3)になる。zoomは29まで。
+# 異なるデータ源の表を、X, Y, Zの3列ではなくこの1列でjoinできる。
+_TILEKEY_ZOOM_SHIFT = np.uint64(58)
+_TILEKEY_MASK = np.uint64((1 << 58) - 1)
+
+
+def _spread(v: np.ndarray) -> np.ndarray:
+    """32bit以下の整数のbitを1つおきに広げる。"""
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact(v: np.ndarray) -> np.ndarray:
+    """_spreadの逆。"""
+    v = v & np.uint64(0x5555555555555555)
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def tilekey(zoom, xy) -> np.ndarray:
+    """タイル番号 [N, 2] を64bitのキー [N] にする。zoomは整数か長さNの配列。"""
+    xy = np.asarray(xy).reshape(-1, 2)
+    zoom = np.asarray(zoom).astype(np.uint64)
+    if np.any(zoom > 29):
+        raise ValueError("tilekey supports zoom <= 29")
+    morton = (_spread(xy[:, 1]) << np.uint64(1)) | _spread(xy[:, 0])
+    return (zoom << _TILEKEY_ZOOM_SHIFT) | morton
+
+
+def tilekey_decode(keys):
+    """tilekey()の逆。
+
+    Returns:
+        (np.ndarray, np.ndarray): zoom [N] とタイル番号 [N, 2]
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    zoom = (keys >> _TILEKEY_ZOOM_SHIFT).astype(int)
+    morton = keys & _TILEKEY_MASK
+    x = _compact(morton).astype(np.int64)
+    y = _compact(morton >> np.uint64(1)).astype(np.int64)
+    return zoom, np.column_stack([x, y])
+
+
+def index_by_tilekey(df):
+    """X, Y, Z列からtilekeyを計算し、indexにする。
+    すでに意味のあるindex(timestampなど)があれば、その後ろに足す。"""
+    import pandas as pd
+
+    df = df.copy()
+    df["tilekey"] = tilekey(df["Z"].to_numpy(), df[["X", "Y"]].to_numpy())
+    default_index = isinstance(df.index, pd.RangeIndex) or df.index.name is None
+    return df.set_index("tilekey", append=not default_index)
+
+
+# ズームの変換。
+# zoom zのタイル(x, y)の親はzoom z-kの(x >> k, y >> k)、子はzoom z+kの
+# (x << k) + dx, (y << k) + dy (0 <= dx, dy < 2**k)。どちらも配列の演算だけで済む。
+
+
+def aggregate(zoom: int, xy, values, levels: int = 1, how: str = "mean"):
+    """zoomのタイルの値を、levelsだけ粗いズームの親タイルに集約する。NaNは欠測として扱う。
+
+    Args:
+        zoom (int): 元のズーム率
+        xy: タイル番号 [N, 2]
+        values: 値 [N] あるいは [N, M]
+        levels (int, optional): 粗くする段数
+        how (str, optional): "mean", "max", "count"(NaNでない子の数)
+
+    Returns:
+        (np.ndarray, np.ndarray): 親のタイル番号 [P, 2] と集約値 [P] あるいは [P, M]
+    """
+    if how not in ("mean", "max", "count"):
+        raise ValueError(f"how must be 'mean', 'max' or 'count', got {how}")
+    xy = np.asarray(xy, dtype=np.int64).reshape(-1, 2)
+    values = np.asarray(values, dtype=float)
+    parents = xy >> levels
+    keys, first, inverse = np.unique(
+        tilekey(zoom - levels, parents), return_index=True, return_inverse=True
+    )
+    shape = (len(keys),) + values.shape[1:]
+    valid = ~np.isnan(values)
+    counts = np.zeros(shape)
+    np.add.at(counts, inverse, valid)
+    if how == "count":
+        result = counts
+    elif how == "mean":
+        sums = np.zeros(shape)
+        np.add.at(sums, inverse, np.where(valid, values, 0.0))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = sums / counts
+    else:
+        result = np.full(shape, -np.inf)
+        np.fmax.at(result, inverse, values)
+        result[counts == 0] = np.nan
+    return parents[first], result
+
+
+def upsample(zoom: int, xy, values, levels: int = 1):
+    """zoomのタイルの値を、levelsだけ細かいズームの子タイルに配る。
+
+    Returns:
+        (np.ndarray, np.ndarray): 子のタイル番号 [N * 4**levels, 2] と値。
+            親ごとに4**levels個の子が続く。
+    """
+    xy = np.asarray(xy, dtype=np.int64).reshape(-1, 2)
+    values = np.asarray(values)
+    side = 1 << levels
+    dy, dx = np.divmod(np.arange(side * side), side)
+    offsets = np.column_stack([dx, dy])
+    children = ((xy << levels)[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+    return children, np.repeat(values, side * side, axis=0)
+
+
+def rezoom_table(df, zoom: int, how: str = "mean", by: str = None):
+    """X, Y, Z列をもつ表(airmonitor.tilesなど)を別のズームの表にする。
+    粗くするときはaggregate、細かくするときはupsampleを使い、lon, latは作りなおす。
+
+    時刻ごとに別々に変換する。時刻はby列か、名前のあるindex(airmonitorの"timestamp"など)。
+    byを与えず、indexに名前もなければ"timestamp"列か"date"列(openmeteo)を使い、
+    それもなければ表全体を1つの時刻として変換する。数値でない列は集約できないので落とす。"""
+    import pandas as pd
+
+    source_zoom = int(df["Z"].iloc[0])
+    if zoom == source_zoom:
+        return df
+    if by is None and df.index.name is None:
+        by = next((c for c in ("timestamp", "date") if c in df.columns), None)
+    value_columns = [
+        c
+        for c in df.select_dtypes(include=["number", "bool"]).columns
+        if c not in ("lon", "lat", "X", "Y", "Z", by)
+    ]
+    if by is not None:
+        groups = df.groupby(by, sort=False)
+    elif df.index.name is not None:
+        groups = df.groupby(level=0, sort=False)
+    else:
+        groups = [(None, df)]
+    frames = []
+    for label, part in groups:
+        xy = part[["X", "Y"]].to_numpy()
+        values = part[value_columns].to_numpy(dtype=float)
+        if zoom < source_zoom:
+            new_xy, new_values = aggregate(
+                source_zoom, xy, values, levels=source_zoom - zoom, how=how
+            )
+        else:
+            new_xy, new_values = upsample(source_zoom, xy, values, zoom - source_zoom)
+        lonlats = lonlat(zoom, xy=new_xy)
+        table = pd.DataFrame(
+            {
+                "lon": lonlats[:, 0],
+                "lat": lonlats[:, 1],
+                "X": new_xy[:, 0],
+                "Y": new_xy[:, 1],
+                "Z": zoom,
+            }
+        )
+        table[value_columns] = new_values
+        if by is not None:
+            table.insert(0, by, label)
+        elif df.index.name is not None:
+            table.index = pd.Index([label] * len(table), name=df.index.name)
+        frames.append(table)
+    return pd.concat(frames, ignore_index=by is not None or df.index.name is None)
+
+
+def _readonly(array: np.ndarray) -> np.ndarray:
+    array = np.ascontiguousarray(array)
+    array.setflags(write=False)
+    return array
+
+
+@dataclass(frozen=True, eq=False)
+class Grid:
+    """ある範囲を覆うタイルの集合。配列はすべて読み出し専用。
+
+    タイルの並びはtiles()と同じで、北の行から順に、各行は西から東。
+    flat indexのiは2次元の(row, col) = (i // shape[1], i % shape[1])に対応する。
+
+    Attributes:
+        zoom (int): ズーム率
+        xy (np.ndarray): タイル番号 [N, 2]
+        shape (tuple): (行数, 列数)
+        lonlats (np.ndarray): タイルの左上角の経度緯度 [N, 2]
+        centers (np.ndarray): タイルの中心の経度緯度 [N, 2]
+        rows (np.ndarray): 各タイルの行番号 [N]
+        cols (np.ndarray): 各タイルの列番号 [N]
+        mask (np.ndarray): 県の境界にかかるタイルならTrue [N]。境界がなければすべてTrue
+        active (np.ndarray): maskがTrueのタイルのflat index
+        fingerprint (str): zoom、範囲とactiveのダイジェスト。境界が変わると変わるので、
+            activeのタイルだけを返す関数のキャッシュのキーに入れる
+    """
+
+    zoom: int
+    xy: np.ndarray
+    shape: tuple
+    lonlats: np.ndarray
+    centers: np.ndarray
+    rows: np.ndarray
+    cols: np.ndarray
+    mask: np.ndarray
+    active: np.ndarray
+    fingerprint: str
+
+    @classmethod
+    def from_range(cls, zoom: int, lonlat_range, rings=None) -> "Grid":
+        """lonlat_rangeを覆うGrid。rings(多角形の境界のリスト)を与えると、
+        それにかかるタイルだけをmaskで選ぶ。"""
+        xy, shape = tiles(zoom, np.asarray(lonlat_range))
+        rows, cols = np.divmod(np.arange(len(xy)), shape[1])
+        if rings:
+            mask = tile_in_polygons(zoom, xy, rings)
+        else:
+            mask = np.ones(len(xy), dtype=bool)
+        active = np.flatnonzero(mask)
+        h = hashlib.blake2b(digest_size=8)
+        h.update(np.array([zoom, *xy[0], *shape], dtype=np.int64).tobytes())
+        h.update(active.astype(np.int64).tobytes())
+        return cls(
+            zoom=zoom,
+            xy=_readonly(xy),
+            shape=(int(shape[0]), int(shape[1])),
+            lonlats=_readonly(lonlat(zoom, xy=xy)),
+            centers=_readonly(np.column_stack(_lonlat(zoom, *(xy + 0.5).T))),
+            rows=_readonly(rows),
+            cols=_readonly(cols),
+            mask=_readonly(mask),
+            active=_readonly(active),
+            fingerprint=h.hexdigest(),
+        )
+
+    def __len__(self) -> int:
+        return len(self.xy)
+
+    def index(self, xy) -> np.ndarray:
+        """タイル番号 [M, 2] のflat index。gridの外のタイルは-1。"""
+        xy = np.asarray(xy, dtype=int).reshape(-1, 2)
+        x0, y0 = self.xy[0]
+        col = xy[:, 0] - x0
+        row = xy[:, 1] - y0
+        inside = (0 <= col) & (col < self.shape[1]) & (0 <= row) & (row < self.shape[0])
+        return np.where(inside, row * self.shape[1] + col, -1)
+
+    def select(self, table):
+        """X, Y列のある表から、県の境界にかかるタイルの行だけを選ぶ。境界がなければそのまま返す。
+
+        キャッシュする関数はactiveのタイルだけを取ってくるので、これは要らない。
+        長方形全体から作った表(ズームを変えた表など)に使う。
+        """
+        if np.all(self.mask):
+            return table
+        i = self.index(table[["X", "Y"]].to_numpy())
+        return table[(i >= 0) & self.mask[np.maximum(i, 0)]]
+
+    def to_2d(self, values) -> np.ndarray:
+        """flatな値 [N, ...] を [行, 列, ...] にする。"""
+        values = np.asarray(values)
+        return values.reshape(self.shape + values.shape[1:])
+
+    def to_flat(self, values) -> np.ndarray:
+        """[行, 列, ...] をflatな値 [N, ...] にする。"""
+        values = np.asarray(values)
+        return values.reshape((len(self),) + values.shape[2:])
+
+
+# 県の境界。
+# prefecture_rangesは長方形なので、海や隣県のタイルも含む。境界のGeoJSONがあれば、
+# それにかかるタイルだけをGrid.maskで選び、下流の処理を減らす。
+BOUNDARY_DIR = os.getenv("ANDERSAN_BOUNDARY_DIR", "/AIR/andersan/boundaries")
+
+
+def load_rings(filename: str) -> list:
+    """GeoJSON(Polygon, MultiPolygon, Feature, FeatureCollection)の境界を、
+    経度緯度の配列 [M, 2] のリストとして読む。穴も1つの境界として含める。"""
+    with open(filename) as f:
+        geojson = json.load(f)
+
+    def geometries(obj):
+        if obj["type"] == "FeatureCollection":
+            for feature in obj["features"]:
+                yield from geometries(feature)
+        elif obj["type"] == "Feature":
+            yield from geometries(obj["geometry"])
+        elif obj["type"] == "GeometryCollection":
+            for geometry in obj["geometries"]:
+                yield from geometries(geometry)
+        else:
+            yield obj
+
+    rings = []
+    for geometry in geometries(geojson):
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        for polygon in polygons:
+            for ring in polygon:
+                rings.append(np.array(ring, dtype=float)[:, :2])
+    return rings
+
+
+def points_in_polygons(points, rings, block: int = 2**20) -> np.ndarray:
+    """点 [N, 2] が境界の内側にあるか。偶奇規則なので、穴や飛び地もそのまま扱える。
+
+    点と辺の組をまとめて配列で判定する。中間の配列が点の数×辺の数になるので、
+    これがblock要素ほどに収まるように、境界ごとに一度に扱う点の数を決める。
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    inside = np.zeros(len(points), dtype=bool)
+    for ring in rings:
+        a = ring
+        b = np.roll(ring, -1, axis=0)
+        lo = np.minimum(a, b).min(axis=0)
+        hi = np.maximum(a, b).max(axis=0)
+        # 境界の外接矩形の外の点は調べない
+        candidates = np.flatnonzero(
+            np.all((lo <= points) & (points <= hi), axis=1)
+        )
+        chunk = max(1, block // len(ring))
+        for start in range(0, len(candidates), chunk):
+            idx = candidates[start : start + chunk]
+            px = points[idx, 0, None]
+            py = points[idx, 1, None]
+            # 点から東へ伸ばした半直線と交わる辺の数
+            straddle = (a[:, 1] > py) != (b[:, 1] > py)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_cross = a[:, 0] + (py - a[:, 1]) * (b[:, 0] - a[:, 0]) / (
+                    b[:, 1] - a[:, 1]
+                )
+            crossings = np.count_nonzero(straddle & (px < x_cross), axis=1)
+            inside[idx] ^= crossings % 2 == 1
+    return inside
+
+
+def tile_in_polygons(zoom: int, xy, rings) -> np.ndarray:
+    """タイル [N, 2] の中心か4隅のどれかが境界の内側にあればTrue。"""
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    offsets = np.array([[0.5, 0.5], [0, 0], [1, 0], [0, 1], [1, 1]])
+    corners = (xy[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+    points = np.column_stack(_lonlat(zoom, corners[:, 0], corners[:, 1]))
+    return points_in_polygons(points, rings).reshape(len(xy), -1).any(axis=1)
+
+
+@lru_cache(maxsize=None)
+def prefecture_rings(prefecture: str) -> tuple:
+    """{BOUNDARY_DIR}/{prefecture}.geojsonの境界。ファイルがなければ空。"""
+    filename = os.path.join(BOUNDARY_DIR, f"{prefecture}.geojson")
+    if not os.path.exists(filename):
+        getLogger().info(f"No boundary for {prefecture}; using the whole range.")
+        return ()
+    return tuple(load_rings(filename))
+
+
+@lru_cache(maxsize=None)
+def grid(prefecture: str, zoom: int) -> Grid:
+    """県の範囲(prefecture_ranges)を覆うGrid。同じ引数には同じオブジェクトを返す。
+    県の境界ファイルがあれば、境界にかかるタイルがmask/activeで選ばれる。"""
+    return Grid.from_range(
+        zoom, prefecture_ranges[prefecture], rings=prefecture_rings(prefecture)
+    )
+
+
+def fingerprint(prefecture: str, zoom: int):
+    """grid(prefecture, zoom).fingerprint。範囲の決まっていない県ならNone。
+    activeのタイルだけを返すキャッシュ関数に引数として渡し、キーに境界を入れる。"""
+    if prefecture not in prefecture_ranges:
+        return None
+    return grid(prefecture, zoom).fingerprint
+
+
 def test():
     #
     # 関数を改造してもちゃんと動くかどうかをいつも確認する。
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("airpollutionwatch")
+
+from andersan import amedas
+
+
+@pytest.fixture
+def stations():
+    table = amedas.StationTable()
+    table._load(
+        {
+            "46106": {"lat": [35, 18.0], "lon": [139, 21.0], "kjName": "平塚"},
+            "46141": {"lat": [35, 36.0], "lon": [139, 30.0], "kjName": "海老名"},
+            "11001": {"lat": [45, 31.0], "lon": [141, 56.0], "kjName": "宗谷岬"},
+            "99999": {"lat": [35, 0.0], "lon": [139, 0.0]},  # 項目が欠けている
+        }
+    )
+    return table
+
+
+@pytest.fixture
+def data():
+    return {
+        "46106": {"temp": [10.5, 0], "wind": [3.0, 0]},
+        "46141": {"temp": [9.0, 0], "wind": [None, 5]},
+        "11001": {"temp": [-2.0, 0], "wind": [8.0, 0]},
+        "99999": {"temp": [1.0, 0], "wind": [1.0, 0]},
+        "12345": {"temp": [1.0, 0], "wind": [1.0, 0]},  # 観測所表にない
+    }
+
+
+def test_decode(stations, data):
+    df = amedas.decode(data, stations)
+    assert sorted(df["code"]) == [11001, 46106, 46141]
+    row = df.set_index("code").loc[46106]
+    assert row["temp"] == 10.5
+    assert row["temp_flag"] == 0
+    assert row["lat"] == pytest.approx(35.3)
+    assert row["lon"] == pytest.approx(139.35)
+    wind = df.set_index("code").loc[46141]
+    assert np.isnan(wind["wind"]) and wind["wind_flag"] == 5
+
+
+def test_decode_range_matches_mask(stations, data):
+    lonlat_range = [[138.5, 35.0], [140.0, 36.0]]
+    full = amedas.decode(data, stations)
+    assert sorted(amedas.decode(data, stations, lonlat_range)["code"]) == [46106, 46141]
+    assert list(amedas._within(full, lonlat_range)["code"]) == list(
+        amedas.decode(data, stations, lonlat_range)["code"]
+    )
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from andersan import interpolation
+
+
+@pytest.fixture
+def stations():
+    rng = np.random.default_rng(0)
+    locations = rng.uniform([139.0, 35.1], [139.8, 35.7], (40, 2))
+    grids = rng.uniform([138.9, 35.0], [139.9, 35.8], (500, 2))
+    return locations, grids
+
+
+def _same(a, b):
+    assert np.array_equal(a.covered, b.covered)
+    np.testing.assert_allclose(a.matrix.toarray(), b.matrix.toarray(), atol=1e-12)
+
+
+@pytest.mark.parametrize("missing", [[0], [3, 7, 8], list(range(0, 40, 3))])
+def test_patch_matches_build(stations, missing):
+    locations, grids = stations
+    valid = np.ones(len(locations), dtype=bool)
+    valid[missing] = False
+    base = interpolation.triangulate(locations, grids)
+    # 欠測局のまわりだけ作りなおしても、欠測のない局だけで作りなおしたものと同じ
+    _same(
+        interpolation.patch(base, locations, grids, valid),
+        interpolation.build(locations[valid], grids),
+    )
+
+
+def test_weight_matrix_with_valid_matches_build(stations):
+    locations, grids = stations
+    valid = np.ones(len(locations), dtype=bool)
+    valid[[1, 2]] = False
+    interpolation.clear_cache()
+    _same(
+        interpolation.weight_matrix(locations, grids, valid=valid),
+        interpolation.build(locations[valid], grids),
+    )
+
+
+def test_interpolate_cube_skips_missing(stations):
+    locations, grids = stations
+    cube = np.stack([locations[:, 0], locations[:, 1]], axis=-1)[np.newaxis]
+    cube[0, 5, 0] = np.nan
+    values = interpolation.interpolate_cube(locations, grids, cube)
+    # 経度と緯度は一次式なので、三角形の内側では正確に内挿される
+    covered = ~np.isnan(values[0, :, 0])
+    assert covered.any()
+    np.testing.assert_allclose(values[0, covered, 0], grids[covered, 0])
+    np.testing.assert_allclose(values[0, covered, 1], grids[covered, 1])
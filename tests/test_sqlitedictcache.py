@@ -0,0 +1,199 @@
+import fcntl
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from andersan.sqlitedictcache import (
+    ARROW_MAGIC,
+    _hashed,
+    _process_lock,
+    _shelf,
+    sqlitedict_cache,
+)
+
+
+def _try_lock(filename, offset, queue):
+    """別のプロセスから、offsetのバイト範囲をブロックせずにロックしてみる。"""
+    with open(filename, "a") as f:
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        except OSError:
+            queue.put(False)
+        else:
+            fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+            queue.put(True)
+
+
+def _lockable_from_other_process(basename, key):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(
+        target=_try_lock, args=(f"{basename}.sqlite.lock", int(key[:8], 16), queue)
+    )
+    p.start()
+    p.join(30)
+    return queue.get(timeout=5)
+
+
+@pytest.fixture
+def keys():
+    return _hashed("x"), _hashed("y")
+
+
+def test_other_thread_does_not_release_lock(tmp_path, keys):
+    basename = str(tmp_path / "cache")
+    x, y = keys
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with _process_lock(basename, x):
+            holding.set()
+            release.wait(30)
+
+    a = threading.Thread(target=hold)
+    a.start()
+    holding.wait(30)
+    try:
+        # 別のスレッドが別のキーをロックして外しても、xのロックは残る
+        with _process_lock(basename, y):
+            pass
+        assert not _lockable_from_other_process(basename, x)
+    finally:
+        release.set()
+        a.join()
+    assert _lockable_from_other_process(basename, x)
+
+
+def test_nested_lock_keeps_outer(tmp_path, keys):
+    basename = str(tmp_path / "cache")
+    x, y = keys
+    with _process_lock(basename, x):
+        with _process_lock(basename, y):
+            pass
+        # 再帰呼び出しで内側を外しても、外側のロックは残る
+        assert not _lockable_from_other_process(basename, x)
+        with _process_lock(basename, x):  # 同じスレッドなら入れ子にできる
+            pass
+        assert not _lockable_from_other_process(basename, x)
+    assert _lockable_from_other_process(basename, x)
+
+
+def test_threads_exclude_each_other(tmp_path, keys):
+    basename = str(tmp_path / "cache")
+    x, _ = keys
+    inside = []
+    peak = []
+
+    def work():
+        with _process_lock(basename, x):
+            inside.append(1)
+            peak.append(len(inside))
+            time.sleep(0.01)
+            inside.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 1
+
+
+def _counted(calls):
+    def f(a, b=2):
+        calls.append((a, b))
+        return a * 10 + b
+
+    return f
+
+
+def test_key_ignores_how_arguments_are_passed(tmp_path):
+    calls = []
+    f = sqlitedict_cache(str(tmp_path / "key"))(_counted(calls))
+    # 位置引数、キーワード引数、既定値のどれで呼んでも同じエントリ
+    assert f(1, 2) == f(1, b=2) == f(a=1) == f(1) == 12
+    assert calls == [(1, 2)]
+    assert f(1, 3) == 13
+    assert len(calls) == 2
+
+
+def test_arrow_round_trip_is_writable(tmp_path):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    basename = str(tmp_path / "arrow")
+    calls = []
+
+    @sqlitedict_cache(basename, codec="arrow")
+    def frame(n):
+        calls.append(n)
+        return pd.DataFrame({"x": range(n), "y": [float(i) / 2 for i in range(n)]})
+
+    expected = frame(4)
+    stored = _shelf(basename)[frame._key((4,), {})]
+    assert isinstance(stored, pd.DataFrame)
+    raw = _shelf(basename).conn.select_one(
+        f'SELECT value FROM "{_shelf(basename).tablename}"'
+    )[0]
+    assert bytes(raw[: len(ARROW_MAGIC)]) == ARROW_MAGIC
+
+    got = frame(4)
+    assert calls == [4]
+    pd.testing.assert_frame_equal(got, expected)
+    # ファイルから読んだ値も書きかえられる
+    got.loc[0, "y"] = -1.0
+    assert got.loc[0, "y"] == -1.0
+
+
+def test_ttl_expires_entries(tmp_path):
+    calls = []
+    f = sqlitedict_cache(str(tmp_path / "ttl"), ttl=0.2)(_counted(calls))
+    f(1)
+    f(1)
+    assert len(calls) == 1
+    time.sleep(0.3)
+    f(1)
+    assert len(calls) == 2
+
+
+def test_max_entries_evicts_least_recently_used(tmp_path):
+    calls = []
+    f = sqlitedict_cache(str(tmp_path / "lru"), max_entries=2)(_counted(calls))
+    f(1)
+    f(2)
+    f(1)  # 2がいちばん古くなる
+    f(3)
+    assert len(_shelf(f.basename)) == 2
+    f(1)
+    assert len(calls) == 3
+    f(2)
+    assert len(calls) == 4
+
+
+def test_none_is_remembered_with_negative_ttl(tmp_path):
+    calls = []
+
+    @sqlitedict_cache(str(tmp_path / "negative"), negative_ttl=60)
+    def nothing(a):
+        calls.append(a)
+        return None
+
+    assert nothing(1) is None
+    assert nothing(1) is None
+    assert calls == [1]
+    assert nothing.stats["negative_hits"] == 1
+
+
+def test_none_is_recomputed_without_negative_ttl(tmp_path):
+    calls = []
+
+    @sqlitedict_cache(str(tmp_path / "none"))
+    def nothing(a):
+        calls.append(a)
+        return None
+
+    nothing(1)
+    nothing(1)
+    assert calls == [1, 1]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from andersan import tile
+
+
+def test_tilekey_round_trip():
+    rng = np.random.default_rng(0)
+    for zoom in (0, 1, 12, 18, 29):
+        xy = rng.integers(0, 2**zoom, (100, 2))
+        zooms, decoded = tile.tilekey_decode(tile.tilekey(zoom, xy))
+        assert np.all(zooms == zoom)
+        assert np.array_equal(decoded, xy)
+
+
+def test_tilekey_rejects_large_zoom():
+    with pytest.raises(ValueError):
+        tile.tilekey(30, [[0, 0]])
+
+
+def _table(zoom, times=None):
+    grid = tile.Grid.from_range(zoom, np.array([[138.94, 35.13], [139.84, 35.66]]))
+    df = pd.DataFrame({"X": grid.xy[:, 0], "Y": grid.xy[:, 1], "Z": zoom, "OX": 1.0})
+    if times is None:
+        return df
+    return pd.concat([df.assign(date=t) for t in times], ignore_index=True)
+
+
+def test_rezoom_table_without_time_key():
+    df = _table(12)
+    coarse = tile.rezoom_table(df, 11)
+    assert len(coarse) == len(np.unique(df[["X", "Y"]].to_numpy() >> 1, axis=0))
+    assert np.all(coarse["OX"] == 1.0)
+
+
+def test_rezoom_table_groups_by_date_column():
+    times = pd.date_range("2024-01-01", periods=3, freq="h", tz="Asia/Tokyo")
+    df = _table(12, times)
+    coarse = tile.rezoom_table(df, 11)
+    assert len(coarse) == 3 * len(tile.rezoom_table(_table(12), 11))
+    assert list(coarse["date"].unique()) == list(times)
+    fine = tile.rezoom_table(df, 13)
+    assert len(fine) == 4 * len(df)
+
+
+def test_select_uses_mask():
+    ring = np.array([[139.0, 35.2], [139.5, 35.2], [139.5, 35.6], [139.0, 35.6]])
+    grid = tile.Grid.from_range(12, [[138.94, 35.13], [139.84, 35.66]], rings=[ring])
+    assert 0 < len(grid.active) < len(grid)
+    df = pd.DataFrame({"X": grid.xy[:, 0], "Y": grid.xy[:, 1]})
+    assert len(grid.select(df)) == len(grid.active)
+    # 境界が変われば、fingerprintも変わる
+    whole = tile.Grid.from_range(12, [[138.94, 35.13], [139.84, 35.66]])
+    assert grid.fingerprint != whole.fingerprint